@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+
+
+#==============================================================================
+class CustomValuesAccessor(object):
+    """
+    Access the custom values of a model instance as attributes or items,
+    named like the custom fields. All the values are loaded at once on first
+    access, changed values are kept in memory until ``save``::
+
+      obj.custom.priority
+      obj.custom['due_date'] = date.today()
+      obj.custom.save()
+
+    Custom fields without a value read as ``None``, unknown names raise
+    ``AttributeError`` (or ``KeyError`` for items).
+    """
+
+    def __init__(self, builder, obj):
+        """
+        :param builder: the ``CustomFieldsBuilder`` of the model
+        :param obj: the model instance
+        """
+        self._builder = builder
+        self._obj = obj
+        self._values = None
+        self._dirty = {}
+
+    def _load(self):
+        if self._values is None:
+            obj = self._obj
+            fields = self._builder.get_fields_for_content_type(obj._content_type)
+            cache = getattr(obj, '_custom_values_cache', None)
+            if cache is None or obj._custom_values_prefetched is not None:
+                cache = self._builder.get_object_values(obj, fields) if obj.pk else {}
+            self._values = dict((f.name, cache[f.pk].value if f.pk in cache else None)
+                                for f in fields)
+        return self._values
+
+    def _check_name(self, name):
+        if name not in self._load():
+            raise KeyError("'%s' is not a custom field of %s" %
+                           (name, self._obj.__class__.__name__))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(e.args[0])
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super(CustomValuesAccessor, self).__setattr__(name, value)
+            return
+        try:
+            self[name] = value
+        except KeyError as e:
+            raise AttributeError(e.args[0])
+
+    def __getitem__(self, name):
+        self._check_name(name)
+        return self._values[name]
+
+    def __setitem__(self, name, value):
+        self._check_name(name)
+        self._values[name] = value
+        self._dirty[name] = value
+
+    def __contains__(self, name):
+        return name in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def keys(self):
+        return list(self._load().keys())
+
+    def items(self):
+        return list(self._load().items())
+
+    def get(self, name, default=None):
+        return self._load().get(name, default)
+
+    @property
+    def dirty(self):
+        """ Returns a dict of the changed values not saved yet """
+        return dict(self._dirty)
+
+    def is_dirty(self):
+        return bool(self._dirty)
+
+    def save(self):
+        """
+        Validate and save the changed values at once, with
+        ``set_custom_values``. Nothing is saved when any value is not valid.
+
+        :raise ValidationError: when any value is not valid
+        """
+        if not self._dirty:
+            return
+        saved = self._obj.set_custom_values(self._dirty)
+        for name, value in saved.items():
+            self._values[name] = value.value
+        self._dirty = {}
+
+    def refresh(self):
+        """ Discard the loaded and changed values, they are loaded again on next access """
+        self._values = None
+        self._dirty = {}
+
+    def _update(self, values):
+        """ Update the loaded values with saved value instances """
+        if self._values is not None:
+            for value in values:
+                name = value._get_custom_field().name
+                self._values[name] = value.value
+                self._dirty.pop(name, None)
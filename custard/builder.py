@@ -1,12 +1,24 @@
 from __future__ import unicode_literals
-from django.db import models
-from django.db.models import Q
+import time
+from collections import defaultdict
+from copy import deepcopy
+from django.db import models, transaction, router
+from django.db.models import Q, F
 from django import forms
 from django.apps import apps
 from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.contenttypes.fields import GenericForeignKey
-from django.core.exceptions import ObjectDoesNotExist, ValidationError, NON_FIELD_ERRORS
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.signals import setting_changed
+from django.core.validators import (MinLengthValidator, MaxLengthValidator,
+    MinValueValidator, MaxValueValidator)
+from django.core.exceptions import (ObjectDoesNotExist, ValidationError, FieldError, ImproperlyConfigured,
+                                    NON_FIELD_ERRORS)
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.signals import post_save, post_delete
+from django.db.models.sql import DeleteQuery
 from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.functional import cached_property
@@ -15,7 +27,13 @@ from django.utils.translation import ugettext_lazy as _
 from .conf import (CUSTOM_TYPE_TEXT, CUSTOM_TYPE_INTEGER, CUSTOM_TYPE_FLOAT,
     CUSTOM_TYPE_TIME, CUSTOM_TYPE_DATE, CUSTOM_TYPE_DATETIME, CUSTOM_TYPE_BOOLEAN,
     settings)
-from .utils import import_class
+from .accessor import CustomValuesAccessor
+from .expressions import CustomValue, IsNull
+from .materialized import MaterializedTable
+from .memo import get_memo
+from .search import SearchBackend
+from .storage import StorageEngine
+from .utils import import_class, bulk_update, after_transaction, EXPORT_FORMATS
 
 
 #==============================================================================
@@ -27,7 +45,9 @@ class CustomFieldsBuilder(object):
 
     #--------------------------------------------------------------------------
     def __init__(self, fields_model, values_model,
-                 custom_content_types=settings.CUSTOM_CONTENT_TYPES):
+                 custom_content_types=settings.CUSTOM_CONTENT_TYPES,
+                 search_backend=None, storage_engine=None,
+                 values_cache=None, values_cache_timeout=DEFAULT_TIMEOUT):
         """
         Custom fields builder class. This helps defining classes to enable
         custom fields in application.
@@ -35,11 +55,18 @@ class CustomFieldsBuilder(object):
         :param fields_model: the app.Model name of fields model
         :param values_model: the app.Model name of the values model
         :param custom_content_types: which content types are allowed to have custom fields
+        :param search_backend: the ``custard.search.SearchBackend`` instance used by search
+        :param storage_engine: the ``custard.storage.StorageEngine`` instance storing values
+        :param values_cache: alias of the Django cache keeping the values of each object
+        :param values_cache_timeout: timeout of the values cache entries
         :return:
         """
         self.fields_model = fields_model.split(".")
         self.values_model = values_model.split(".")
         self.custom_content_types = custom_content_types
+        self.search_backend = search_backend or SearchBackend()
+        self.storage_engine = storage_engine or StorageEngine()
+        self.storage_engine.builder = self
         if self.custom_content_types and len(self.custom_content_types):
             self.content_types_query = None
             for c in self.custom_content_types:
@@ -52,6 +79,28 @@ class CustomFieldsBuilder(object):
         else:
             self.content_types_query = Q()
 
+        # custom fields definitions per content type, invalidated on change
+        self._fields_cache = {}
+        self._baked_form_fields = {}
+        self.fields_version = 0
+        fields_model_name = '.'.join(self.fields_model)
+        post_save.connect(self._fields_changed, sender=fields_model_name)
+        post_delete.connect(self._fields_changed, sender=fields_model_name)
+
+        # keep the search backend index in sync with values
+        post_delete.connect(self._value_deleted, sender='.'.join(self.values_model))
+
+        # form field and widget classes by dotted path, invalidated on settings change
+        self._types_cache = {}
+        setting_changed.connect(self._settings_changed)
+
+        # wide tables of custom values, see materialize
+        self.materialized_tables = []
+
+        # values of each object shared across processes, see get_object_values
+        self.values_cache = values_cache
+        self.values_cache_timeout = values_cache_timeout
+
     #--------------------------------------------------------------------------
     @property
     def fields_model_class(self):
@@ -61,6 +110,800 @@ class CustomFieldsBuilder(object):
     def values_model_class(self):
         return apps.get_model(self.values_model[0], self.values_model[1])
 
+    #--------------------------------------------------------------------------
+    def import_type(self, name):
+        """
+        Returns the class with the given dotted path, importing it only the
+        first time it's requested
+
+        :param name: dotted path of the class, like ``django.forms.fields.CharField``
+        :return: the class
+        """
+        try:
+            return self._types_cache[name]
+        except KeyError:
+            self._types_cache[name] = import_class(name)
+            return self._types_cache[name]
+
+    def _settings_changed(self, sender, setting, **kwargs):
+        if setting in ('CUSTOM_FIELD_TYPES', 'CUSTOM_WIDGET_TYPES'):
+            self._types_cache.clear()
+
+    #--------------------------------------------------------------------------
+    def values_saved(self, values):
+        """
+        Called after value instances have been saved, either one by one or
+        in bulk by the builder
+
+        :param values: the saved value instances
+        """
+        self.search_backend.index_values(values)
+        self._refresh_materialized(values)
+        self.invalidate_values_cache(values)
+
+    def values_deleted(self, values):
+        """
+        Called after value instances have been deleted
+
+        :param values: the deleted value instances
+        """
+        self.search_backend.unindex_values(values)
+        self._refresh_materialized(values)
+        self.invalidate_values_cache(values)
+
+    def _value_deleted(self, sender, instance, **kwargs):
+        self.values_deleted([instance])
+
+    #--------------------------------------------------------------------------
+    def get_object_values(self, obj, fields):
+        """
+        Returns the values of the given custom fields of an object, read from
+        the storage engine. When ``values_cache`` is set, the values of all
+        the custom fields of the object are kept in that cache, and the value
+        instances are built from it until values of the object are written
+        or deleted. Inside ``custard.memo.memoize`` they are also kept in the
+        memo, until the end of the block.
+
+        :param obj: the model instance
+        :param fields: the custom field instances
+        :return: dict of custom field primary keys to value instances
+        """
+        memo = get_memo()
+        if (self.values_cache is None and memo is None) or not self.storage_engine.cache_values:
+            return self.storage_engine.get_values(obj, fields)
+
+        content_type = ContentType.objects.get_for_model(obj)
+        key = self.get_values_cache_key(content_type.pk, obj.pk)
+        data = memo.get(key) if memo is not None else None
+        if data is None and self.values_cache is not None:
+            data = caches[self.values_cache].get(key)
+        if data is None:
+            values = self.storage_engine.get_values(obj, self.get_fields_for_content_type(content_type))
+            data = dict((field_pk, (value.pk, value.value)) for field_pk, value in values.items())
+            if self.values_cache is not None:
+                caches[self.values_cache].set(key, data, self.values_cache_timeout)
+        if memo is not None:
+            memo[key] = data
+
+        values_model = self.values_model_class
+        values = {}
+        for field in fields:
+            if field.pk in data:
+                value_pk, value = data[field.pk]
+                instance = values_model(pk=value_pk,
+                                        custom_field=field,
+                                        content_type_id=content_type.pk,
+                                        object_id=obj.pk)
+                setattr(instance, self.value_column(field), value)
+                instance._state.adding = False
+                instance._state.db = router.db_for_read(values_model)
+                values[field.pk] = instance
+        return values
+
+    def get_values_cache_key(self, content_type_id, object_id):
+        """ Returns the values cache key of an object """
+        return 'custard:%s:%s:%s' % (self.values_model_class._meta.db_table, content_type_id, object_id)
+
+    def invalidate_values_cache(self, values):
+        """
+        Remove the objects of the given value instances from the values cache
+        and the memo. Inside a transaction the cache keys are removed again
+        when it ends, since other processes may have cached the values
+        committed before.
+
+        :param values: the value instances
+        """
+        memo = get_memo()
+        if self.values_cache is None and memo is None:
+            return
+        keys = set(self.get_values_cache_key(value.content_type_id, value.object_id)
+                   for value in values)
+        if memo is not None:
+            for key in keys:
+                memo.pop(key, None)
+        if keys and self.values_cache is not None:
+            cache = caches[self.values_cache]
+            cache.delete_many(list(keys))
+            after_transaction(lambda: cache.delete_many(list(keys)),
+                              using=router.db_for_write(self.values_model_class))
+
+    #--------------------------------------------------------------------------
+    def materialize(self, model, db_table=None, using=None):
+        """
+        Maintain a wide table with the custom values of a model, one row per
+        object and one indexed column per custom field. The table rows are
+        refreshed whenever values are written through the builder.
+        ``filter_custom`` lookups on the model then run on the wide table.
+
+        The table must be created once with ``rebuild``, and built again
+        with ``rebuild`` when the model custom fields change: meanwhile it's
+        stale, and ``filter_custom`` queries the values table instead.
+
+        :param model: the model class
+        :param db_table: the table name, defaults to the model table name
+                         followed by ``_custom``
+        :param using: the database alias
+        :return: the ``custard.materialized.MaterializedTable`` instance
+        """
+        self.check_values_model('materialize')
+        table = MaterializedTable(self, model, db_table=db_table, using=using)
+        self.materialized_tables.append(table)
+        return table
+
+    def get_materialized_table(self, content_type):
+        """
+        Returns the materialized table of a content type, if any
+
+        :param content_type: content type instance (or its primary key)
+        :return: the ``MaterializedTable`` instance or None
+        """
+        content_type_id = getattr(content_type, 'pk', content_type)
+        for table in self.materialized_tables:
+            if table.content_type.pk == content_type_id:
+                return table
+        return None
+
+    def _refresh_materialized(self, values):
+        if not self.materialized_tables:
+            return
+        object_ids = defaultdict(set)
+        for value in values:
+            object_ids[value.content_type_id].add(value.object_id)
+        for content_type_id, ids in object_ids.items():
+            table = self.get_materialized_table(content_type_id)
+            # stale tables are filled again by their rebuild
+            if table is not None and not table.is_stale():
+                table.refresh(ids)
+
+    #--------------------------------------------------------------------------
+    def get_fields_for_content_type(self, content_type):
+        """
+        Returns all the custom fields defined for a content type. Fields are
+        loaded once per content type and kept in memory until any custom field
+        is saved or deleted.
+
+        :param content_type: content type instance (or its primary key)
+        :return: a tuple of custom field instances
+        """
+        content_type_id = getattr(content_type, 'pk', content_type)
+        try:
+            return self._fields_cache[content_type_id]
+        except KeyError:
+            fields = tuple(self.fields_model_class.objects.filter(content_type_id=content_type_id))
+            self._fields_cache[content_type_id] = fields
+            return fields
+
+    def get_field_for_name(self, content_type, name):
+        """
+        Returns the custom field with a given name defined for a content type
+
+        :param content_type: content type instance (or its primary key)
+        :param name: the custom field name
+        :return: the custom field instance
+        :raise FieldError: when no custom field with that name exists
+        """
+        for field in self.get_fields_for_content_type(content_type):
+            if field.name == name:
+                return field
+        raise FieldError("Cannot resolve keyword '%s' into a custom field" % name)
+
+    def get_field_for_id(self, content_type, field_id):
+        """
+        Returns the custom field with a given primary key defined for a
+        content type, without querying the database when fields are cached
+
+        :param content_type: content type instance (or its primary key)
+        :param field_id: the custom field primary key
+        :return: the custom field instance, or None when not found
+        """
+        for field in self.get_fields_for_content_type(content_type):
+            if field.pk == field_id:
+                return field
+        return None
+
+    @staticmethod
+    def value_column(field):
+        """
+        Returns the name of the values model column holding values of a field
+
+        :param field: the custom field instance
+        :return: the column name, like ``value_integer``
+        """
+        return 'value_%s' % field.data_type
+
+    def check_values_model(self, feature):
+        """
+        Check that the storage engine keeps the values in the values model,
+        which the features querying the values table rely on
+
+        :param feature: name of the feature, for the error message
+        :raise ImproperlyConfigured: when the values are stored elsewhere
+        """
+        if not self.storage_engine.uses_values_model:
+            raise ImproperlyConfigured("%s needs the values stored in the values model, "
+                                       "it's not supported by %s" %
+                                       (feature, self.storage_engine.__class__.__name__))
+
+    def get_value_expression(self, model, field):
+        """
+        Returns an expression selecting the value of a custom field for each
+        instance of a model, as a correlated subquery on the values table
+
+        :param model: the model class
+        :param field: the custom field instance
+        :return: the ``custard.expressions.CustomValue`` expression, to be
+                 used in ``annotate``
+        """
+        self.check_values_model('get_value_expression')
+        values_model = self.values_model_class
+        return CustomValue(values_model, field, values_model._meta.get_field(self.value_column(field)))
+
+    def filter_queryset(self, queryset, **kwargs):
+        """
+        Filter a queryset of any model by custom field values, see
+        ``CustomQuerySet.filter_custom``
+
+        :param queryset: the queryset to filter
+        :param kwargs: lookups on custom field names
+        :return: the filtered queryset
+        """
+        self.check_values_model('filter_custom')
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        table = self.get_materialized_table(content_type)
+        if table is not None and not table.is_stale():
+            return table.filter_queryset(queryset, **kwargs)
+        pk_in = str('%s__in' % queryset.model._meta.pk.name)
+        for lookup, value in kwargs.items():
+            name, _, value_lookup = lookup.partition(LOOKUP_SEP)
+            field = self.get_field_for_name(content_type, name)
+            column = self.value_column(field)
+            values = self.values_model_class.objects.filter(custom_field=field,
+                                                             content_type=content_type)
+            if value_lookup == 'isnull':
+                # objects without a value row have a null value too
+                values = values.filter(**{ str('%s__isnull' % column): False })
+                if value:
+                    queryset = queryset.exclude(**{ pk_in: values.values('object_id') })
+                else:
+                    queryset = queryset.filter(**{ pk_in: values.values('object_id') })
+            else:
+                if value_lookup:
+                    column = '%s%s%s' % (column, LOOKUP_SEP, value_lookup)
+                values = values.filter(**{ str(column): value })
+                queryset = queryset.filter(**{ pk_in: values.values('object_id') })
+        return queryset
+
+    def annotate_queryset(self, queryset, *field_names):
+        """
+        Annotate a queryset of any model with the values of the given custom
+        fields, see ``CustomQuerySet.with_custom_fields``
+
+        :param queryset: the queryset to annotate
+        :param field_names: names of the custom fields
+        :return: the annotated queryset
+        """
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        return queryset.annotate(**dict(
+            (str(name), self.get_value_expression(queryset.model,
+                                                  self.get_field_for_name(content_type, name)))
+            for name in field_names))
+
+    def resolve_custom_expression(self, model, expression):
+        """
+        Replace the references to custom field names in an expression (like
+        the ``F`` objects, or the field names given to an aggregate) with the
+        expressions selecting the custom values, see ``get_value_expression``
+
+        :param model: the model class
+        :param expression: the expression, like ``Sum('priority')``
+        :return: a copy of the expression
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        fields = dict((f.name, f) for f in self.get_fields_for_content_type(content_type))
+
+        def resolve(expression):
+            if isinstance(expression, F):
+                if expression.name in fields:
+                    return self.get_value_expression(model, fields[expression.name])
+                return expression
+            if not hasattr(expression, 'get_source_expressions'):
+                return expression
+            expression = expression.copy()
+            expression.set_source_expressions([resolve(e) for e in expression.get_source_expressions()])
+            return expression
+
+        return resolve(expression)
+
+    def invalidate_fields(self):
+        """
+        Discard the custom fields definitions kept in memory, they will be
+        loaded again from the database when needed. This also increments
+        ``fields_version`` and discards the baked form fields.
+        """
+        self._fields_cache.clear()
+        self._baked_form_fields.clear()
+        self.fields_version += 1
+
+    def get_baked_form_fields(self, key):
+        """
+        Returns the custom form fields baked by a form created with
+        ``bake_custom_fields``, to be copied by each form instance
+
+        :param key: the content type primary key and fields version, followed
+                    by the form methods building the fields
+        :return: dict of names to form fields, or None when not baked yet
+        """
+        return self._baked_form_fields.get(key)
+
+    def set_baked_form_fields(self, key, form_fields):
+        """ Keep the custom form fields baked for a key, see ``get_baked_form_fields`` """
+        self._baked_form_fields[key] = form_fields
+
+    def _fields_changed(self, sender, instance, **kwargs):
+        self.invalidate_fields()
+        # once more when the transaction ends, so a rolled back change or
+        # fields read before the commit don't stay in memory
+        after_transaction(self.invalidate_fields, using=router.db_for_write(self.fields_model_class))
+
+    #--------------------------------------------------------------------------
+    def save_custom_values(self, content_type, values, batch_size=500):
+        """
+        Set custom values of many objects of the same content type at once.
+        Existing values are loaded with one query per batch of objects, then
+        all the values are validated in memory with ``clean_custom_value``,
+        like imported values, and finally written inside a
+        single transaction with one ``bulk_create`` for the new values and one
+        update query per data type for the changed ones.
+
+        :param content_type: content type of the objects
+        :param values: dict of object ids to dicts of custom field (or field
+                       name) to value
+        :param batch_size: how many objects are loaded and written per query
+        :return: dict of object ids to dicts of custom field ids to value
+                 instances
+        :raise ValidationError: when any value is not valid, nothing is saved
+        """
+        values_model = self.values_model_class
+        fields = {}
+        for field_values in values.values():
+            for field in field_values:
+                if not isinstance(field, models.Model) and field not in fields:
+                    fields[field] = self.get_field_for_name(content_type, field)
+
+        object_ids = list(values.keys())
+        result = defaultdict(dict)
+        created, updated, errors = [], [], {}
+        for start in range(0, len(object_ids), batch_size):
+            batch = object_ids[start:start + batch_size]
+            existing = {}
+            for value in values_model.objects.filter(content_type=content_type,
+                                                     object_id__in=batch):
+                existing[(value.object_id, value.custom_field_id)] = value
+
+            for object_id in batch:
+                for field, new_value in values[object_id].items():
+                    field = fields.get(field, field)
+                    column = self.value_column(field)
+                    try:
+                        new_value = self.clean_custom_value(field, new_value)
+                    except ValidationError as e:
+                        errors.setdefault(field.name, []).extend(e.messages)
+                        continue
+                    value = existing.get((object_id, field.pk))
+                    if value is None:
+                        value = values_model(custom_field=field,
+                                             content_type_id=field.content_type_id,
+                                             object_id=object_id)
+                        created.append(value)
+                    elif getattr(value, column) != new_value:
+                        value.custom_field = field
+                        updated.append(value)
+                    else:
+                        value.custom_field = field
+                        result[object_id][field.pk] = value
+                        continue
+                    setattr(value, column, new_value)
+                    result[object_id][field.pk] = value
+
+        if errors:
+            raise ValidationError(errors)
+
+        self.write_custom_values(created, updated, batch_size=batch_size)
+        return result
+
+    def write_custom_values(self, created, updated, batch_size=500):
+        """
+        Write many value instances inside a single transaction, with one
+        ``bulk_create`` for the new values and one update query per data type
+        for the changed ones. Values are not validated. The primary keys of the
+        new values are read back when the database doesn't return them.
+
+        :param created: new value instances, with ``content_type`` set
+        :param updated: changed value instances, already in the database
+        :param batch_size: how many values are written per query
+        """
+        with transaction.atomic():
+            if created:
+                self.values_model_class.objects.bulk_create(created, batch_size=batch_size)
+                self._fetch_created_pks(created, batch_size)
+            columns = defaultdict(list)
+            for value in updated:
+                columns[self.value_column(value.custom_field)].append(value)
+            for column, column_values in columns.items():
+                bulk_update(column_values, [column], batch_size=batch_size)
+            self.values_saved(list(created) + list(updated))
+
+    def _fetch_created_pks(self, created, batch_size):
+        """
+        Set the primary key of value instances inserted by ``bulk_create``,
+        with one query per batch, so they can be cached and saved again
+        """
+        using = router.db_for_write(self.values_model_class)
+        missing = [value for value in created if value.pk is None]
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            pks = {}
+            # ordered by pk, so the newest row wins over any older duplicate
+            for row in self.values_model_class.objects.using(using).filter(
+                    content_type__in=set(v.content_type_id for v in batch),
+                    object_id__in=set(v.object_id for v in batch),
+                    custom_field__in=set(v.custom_field_id for v in batch)) \
+                    .order_by('pk').values_list('pk', 'content_type', 'object_id', 'custom_field'):
+                pks[row[1:]] = row[0]
+            for value in batch:
+                value.pk = pks.get((value.content_type_id, value.object_id, value.custom_field_id))
+        for value in created:
+            value._state.adding = False
+            value._state.db = using
+
+    #--------------------------------------------------------------------------
+    def clean_custom_value(self, field, value):
+        """
+        Convert a value (like a string read from a file) to the data type of
+        a custom field, then validate it against the values column and the
+        field ``required``, ``min_length``, ``max_length``, ``min_value`` and
+        ``max_value``. Used by both ``save_custom_values`` and
+        ``import_custom_values``.
+
+        :param field: the custom field instance
+        :param value: the value to clean, empty strings are considered null
+        :return: the converted value
+        :raise ValidationError: when the value is not valid
+        """
+        if value == '':
+            value = None
+        model_field = self.values_model_class._meta.get_field(self.value_column(field))
+        value = model_field.to_python(value)
+        if value is None:
+            if field.required:
+                raise ValidationError(model_field.error_messages['null'], code='null')
+            return value
+        model_field.run_validators(value)
+        checks = []
+        if field.data_type == CUSTOM_TYPE_TEXT:
+            checks = [(MinLengthValidator, field.min_length), (MaxLengthValidator, field.max_length)]
+        elif field.data_type in (CUSTOM_TYPE_INTEGER, CUSTOM_TYPE_FLOAT):
+            checks = [(MinValueValidator, field.min_value), (MaxValueValidator, field.max_value)]
+        errors = []
+        for validator, limit in checks:
+            if limit is not None:
+                try:
+                    validator(limit)(value)
+                except ValidationError as e:
+                    errors.extend(e.error_list)
+        if errors:
+            raise ValidationError(errors)
+        return value
+
+    def import_custom_values(self, model, rows, id_column='pk', batch_size=500, on_conflict='update'):
+        """
+        Import custom values of many objects of a model, from an iterable of
+        dicts of custom field names to values, like the rows read from a CSV
+        file. Custom fields are resolved once, each batch of rows takes one
+        query to check the objects, one to load the existing values and then
+        it's written in its own transaction.
+
+        Columns named like a field of the model, as exported with
+        ``model_fields``, are ignored. Rows with errors are skipped without
+        aborting the import, and are reported with their number (starting
+        from 1) and the errors keyed by column name.
+
+        :param model: the model class (or its content type)
+        :param rows: iterable of dicts, holding the object primary key in
+                     ``id_column`` and custom field names to values
+        :param id_column: the key of the object primary key in each row
+        :param batch_size: how many rows are validated and written at once
+        :param on_conflict: what to do with values already existing for an
+                            object, ``update`` them, ``skip`` them or report
+                            an ``error`` for the row
+        :return: dict with the number of values ``created``, ``updated`` and
+                 ``skipped``, and a list of ``(row number, errors)`` tuples
+                 in ``errors``
+        """
+        if on_conflict not in ('update', 'skip', 'error'):
+            raise ValueError("Unknown conflict handling: %s" % on_conflict)
+        self.check_values_model('import_custom_values')
+        if isinstance(model, ContentType):
+            content_type = model
+        else:
+            content_type = ContentType.objects.get_for_model(model)
+        model = content_type.model_class()
+        fields = dict((f.name, f) for f in self.get_fields_for_content_type(content_type))
+        model_columns = set(['pk'])
+        for model_field in model._meta.concrete_fields:
+            model_columns.update([model_field.name, model_field.attname])
+        result = { 'created': 0, 'updated': 0, 'skipped': 0, 'errors': [] }
+
+        batch = []
+        for number, row in enumerate(rows, 1):
+            batch.append((number, row))
+            if len(batch) >= batch_size:
+                self._import_batch(model, content_type, fields, model_columns, batch, id_column,
+                                   on_conflict, result)
+                batch = []
+        if batch:
+            self._import_batch(model, content_type, fields, model_columns, batch, id_column,
+                               on_conflict, result)
+        return result
+
+    def _import_batch(self, model, content_type, fields, model_columns, batch, id_column,
+                      on_conflict, result):
+        values_model = self.values_model_class
+        pk_field = model._meta.pk
+        cleaned, batch_errors = [], []
+        for number, row in batch:
+            errors, row_values = {}, {}
+            try:
+                object_id = pk_field.to_python(row.get(id_column))
+                if object_id is None:
+                    raise ValidationError(pk_field.error_messages['null'], code='null')
+            except ValidationError as e:
+                errors[id_column] = e.messages
+            for name, value in row.items():
+                if name == id_column:
+                    continue
+                field = fields.get(name)
+                if field is None and name in model_columns:
+                    continue
+                if field is None:
+                    errors[name] = [_('Unknown custom field')]
+                    continue
+                try:
+                    row_values[field] = self.clean_custom_value(field, value)
+                except ValidationError as e:
+                    errors[name] = e.messages
+            if errors:
+                batch_errors.append((number, errors))
+            else:
+                cleaned.append((number, object_id, row_values))
+
+        object_ids = set(object_id for number, object_id, row_values in cleaned)
+        existing_objects = set(model._default_manager.filter(pk__in=object_ids)
+                                                     .values_list('pk', flat=True))
+        existing = {}
+        for value in values_model.objects.filter(content_type=content_type,
+                                                 object_id__in=existing_objects):
+            existing[(value.object_id, value.custom_field_id)] = value
+
+        created, updated = {}, {}
+        for number, object_id, row_values in cleaned:
+            if object_id not in existing_objects:
+                batch_errors.append((number, { id_column: [_('Object does not exist')] }))
+                continue
+            if on_conflict == 'error':
+                conflicts = [field.name for field in row_values if (object_id, field.pk) in existing]
+                if conflicts:
+                    batch_errors.append((number, dict((name, [_('Value already exists')])
+                                                          for name in conflicts)))
+                    continue
+            for field, new_value in row_values.items():
+                column = self.value_column(field)
+                key = (object_id, field.pk)
+                value = existing.get(key) or created.get(key)
+                if value is None:
+                    if new_value is None:
+                        continue
+                    value = values_model(custom_field=field,
+                                         content_type_id=content_type.pk,
+                                         object_id=object_id)
+                    created[key] = value
+                elif key in existing and on_conflict == 'skip':
+                    result['skipped'] += 1
+                    continue
+                elif key in existing:
+                    value.custom_field = field
+                    if getattr(value, column) == new_value:
+                        continue
+                    updated[key] = value
+                setattr(value, column, new_value)
+
+        self.write_custom_values(list(created.values()), list(updated.values()),
+                                 batch_size=len(batch))
+        result['errors'].extend(sorted(batch_errors, key=lambda error: error[0]))
+        result['created'] += len(created)
+        result['updated'] += len(updated)
+
+    #--------------------------------------------------------------------------
+    def prefetch_custom_values(self, instances, *field_names):
+        """
+        Load the custom values of all the given model instances with a single
+        query and attach them to each instance, so that ``get_custom_value``
+        is then served from memory.
+
+        :param instances: model instances (all of the same model)
+        :param field_names: names of the custom fields to load, all if empty
+        :return: the list of instances
+        """
+        self.check_values_model('prefetch_custom_values')
+        instances = [obj for obj in instances
+                     if isinstance(obj, models.Model) and obj.pk is not None]
+        if not instances:
+            return instances
+
+        content_type = ContentType.objects.get_for_model(instances[0])
+        fields = dict((f.pk, f) for f in self.get_fields_for_content_type(content_type)
+                      if not field_names or f.name in field_names)
+        values = self.values_model_class.objects \
+            .filter(content_type=content_type,
+                    object_id__in=set(obj.pk for obj in instances))
+        if field_names:
+            values = values.filter(custom_field__in=list(fields.keys()))
+
+        values_by_object = defaultdict(dict)
+        for value in (values if fields else ()):
+            if value.custom_field_id in fields:
+                value.custom_field = fields[value.custom_field_id]
+            values_by_object[value.object_id][value.custom_field_id] = value
+
+        prefetched = frozenset(field_names) if field_names else None
+        for obj in instances:
+            obj._custom_values_cache = values_by_object.get(obj.pk, {})
+            obj._custom_values_prefetched = prefetched
+        return instances
+
+    #--------------------------------------------------------------------------
+    def iter_custom_values(self, queryset, field_names=(), chunk_size=1000):
+        """
+        Iterate over the instances of a queryset together with their custom
+        values, walking the queryset by primary key in chunks: each chunk
+        takes one query for the instances and one for their values, so memory
+        is bounded by ``chunk_size`` whatever the size of the queryset.
+
+        :param queryset: the queryset to iterate, its ordering is ignored
+        :param field_names: names of the custom fields to load, all if empty
+        :param chunk_size: how many instances are loaded in each chunk
+        :return: a generator of ``(instance, {field name: value})`` tuples
+        """
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        if field_names:
+            fields = [self.get_field_for_name(content_type, name) for name in field_names]
+        else:
+            fields = self.get_fields_for_content_type(content_type)
+        pk_name = queryset.model._meta.pk.name
+        queryset = queryset.order_by(pk_name)
+        chunk = list(queryset[:chunk_size])
+        while chunk:
+            self.prefetch_custom_values(chunk, *[f.name for f in fields])
+            for obj in chunk:
+                values = obj._custom_values_cache
+                yield obj, dict((f.name, values[f.pk].value if f.pk in values else None)
+                                for f in fields)
+            if len(chunk) < chunk_size:
+                break
+            chunk = list(queryset.filter(**{ str('%s__gt' % pk_name): chunk[-1].pk })[:chunk_size])
+
+    def export_custom_values(self, queryset, format='csv', field_names=(), model_fields=('pk',),
+                             chunk_size=1000):
+        """
+        Export the instances of a queryset with their custom values, as a
+        generator of lines which can be written to a file or passed to a
+        ``StreamingHttpResponse``
+
+        :param queryset: the queryset to export
+        :param format: ``csv`` or ``jsonl`` (JSON Lines)
+        :param field_names: names of the custom fields to export, all if empty
+        :param model_fields: names of the model attributes to export first
+        :param chunk_size: how many instances are loaded in each query
+        :return: a generator of text lines
+        """
+        try:
+            lines = EXPORT_FORMATS[format]
+        except KeyError:
+            raise ValueError("Unknown export format: %s" % format)
+        self.check_values_model('export_custom_values')
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        if not field_names:
+            field_names = [f.name for f in self.get_fields_for_content_type(content_type)]
+        columns = list(model_fields) + list(field_names)
+
+        def rows():
+            for obj, values in self.iter_custom_values(queryset, field_names, chunk_size):
+                for name in model_fields:
+                    values[name] = getattr(obj, name)
+                yield values
+
+        return lines(columns, rows())
+
+    #--------------------------------------------------------------------------
+    def delete_orphan_values(self, content_type, chunk_size=1000, sleep=0, dry_run=False,
+                             include_stale=False):
+        """
+        Delete the values of a content type whose object doesn't exist
+        anymore, like after a ``QuerySet.delete`` on a model without
+        ``create_relation``. Objects are looked up with the model base
+        manager, so rows hidden by the default manager keep their values.
+        The values table is walked by primary key in chunks, each chunk
+        taking one query for the values, one for the existing objects and
+        one short transaction to delete its orphans, so it can run on a live
+        database.
+
+        Orphans are deleted with a raw delete query: no ``post_delete``
+        signal is sent for them, so receivers of the values model aren't
+        called. Instead ``values_deleted`` is called once per chunk, after
+        its transaction is committed, to update the search backend,
+        materialized tables and values cache.
+
+        A content type without model (a stale content type, or an app missing
+        from ``INSTALLED_APPS``) is skipped, unless ``include_stale`` is set:
+        then all its values are orphans.
+
+        :param content_type: the content type whose values are checked
+        :param chunk_size: how many values are checked in each chunk
+        :param sleep: seconds to wait between chunks, to throttle the load
+        :param dry_run: only count the orphans, without deleting them
+        :param include_stale: delete all the values of a content type without model
+        :return: the number of orphan values
+        """
+        model = content_type.model_class()
+        if model is None and not include_stale:
+            return 0
+        values_model = self.values_model_class
+        using = router.db_for_write(values_model)
+        values = values_model.objects.using(using).filter(content_type=content_type).order_by('pk')
+        count, last = 0, None
+        while True:
+            chunk = values if last is None else values.filter(pk__gt=last)
+            chunk = list(chunk.values_list('pk', 'object_id')[:chunk_size])
+            if not chunk:
+                break
+            last = chunk[-1][0]
+            existing = set()
+            if model is not None:
+                existing = set(model._base_manager.filter(pk__in=set(o for pk, o in chunk))
+                                                  .values_list('pk', flat=True))
+            orphans = [pk for pk, object_id in chunk if object_id not in existing]
+            count += len(orphans)
+            if orphans and not dry_run:
+                with transaction.atomic(using=using):
+                    deleted = list(values_model.objects.using(using).filter(pk__in=orphans))
+                    DeleteQuery(values_model).delete_batch([value.pk for value in deleted], using)
+                self.values_deleted(deleted)
+            if len(chunk) < chunk_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+        return count
+
     #--------------------------------------------------------------------------
     def create_fields(self, base_model=models.Model, base_manager=models.Manager):
         """
@@ -148,17 +991,25 @@ class CustomFieldsBuilder(object):
         return CustomContentTypeField
 
     #--------------------------------------------------------------------------
-    def create_values(self, base_model=models.Model, base_manager=models.Manager):
+    def create_values(self, base_model=models.Model, base_manager=models.Manager,
+                      indexes=(('content_type', 'object_id'),),
+                      typed_indexes=(CUSTOM_TYPE_INTEGER, CUSTOM_TYPE_FLOAT,
+                                     CUSTOM_TYPE_DATE, CUSTOM_TYPE_DATETIME)):
         """
         This method will create a model which will hold field values for
         field types of custom_field_model.
 
         :param base_model:
         :param base_manager:
+        :param indexes: composite indexes of the model, as tuples of field names
+        :param typed_indexes: data types whose values column is indexed together
+                              with ``custom_field``, for range lookups
         :return:
         """
 
         _builder = self
+        _index_together = [tuple(index) for index in indexes] + \
+                          [('custom_field', 'value_%s' % data_type) for data_type in typed_indexes]
 
         class CustomContentTypeFieldValueManager(base_manager):
             def create(self, **kwargs):
@@ -195,29 +1046,50 @@ class CustomFieldsBuilder(object):
 
             objects = CustomContentTypeFieldValueManager()
 
+            def _get_custom_field(self):
+                """
+                Returns the custom field of this value, taking it from the
+                builder fields cache instead of fetching the foreign key
+                """
+                cache_name = self._meta.get_field('custom_field').get_cache_name()
+                if not hasattr(self, cache_name) and self.content_type_id is not None:
+                    field = _builder.get_field_for_id(self.content_type_id, self.custom_field_id)
+                    if field is not None:
+                        self.custom_field = field
+                return self.custom_field
+
             def _get_value(self):
-                return getattr(self, 'value_%s' % self.custom_field.data_type)
+                return getattr(self, 'value_%s' % self._get_custom_field().data_type)
 
             def _set_value(self, new_value):
-                setattr(self, 'value_%s' % self.custom_field.data_type, new_value)
+                setattr(self, 'value_%s' % self._get_custom_field().data_type, new_value)
 
             value = property(_get_value, _set_value)
 
+            @classmethod
+            def from_db(cls, db, field_names, values):
+                instance = super(CustomContentTypeFieldValue, cls).from_db(db, field_names, values)
+                # remember the loaded values, so hooks can tell what changed on save
+                instance._loaded_values = dict(zip(field_names, values))
+                return instance
+
             class Meta:
                 unique_together = ('custom_field', 'content_type', 'object_id')
+                index_together = _index_together
                 verbose_name = _('custom field value')
                 verbose_name_plural = _('custom field values')
                 abstract = True
 
             def save(self, *args, **kwargs):
                 # save content type as user shouldn't be able to change it
-                self.content_type = self.custom_field.content_type
+                self.content_type_id = self._get_custom_field().content_type_id
                 super(CustomContentTypeFieldValue, self).save(*args, **kwargs)
+                _builder.values_saved([self])
 
             def validate_unique(self, exclude=None):
                 qs = self.__class__._default_manager.filter(
-                    custom_field=self.custom_field,
-                    content_type=self.custom_field.content_type,
+                    custom_field_id=self.custom_field_id,
+                    content_type_id=self._get_custom_field().content_type_id,
                     object_id=self.object_id,
                 )
                 if not self._state.adding and self.pk is not None:
@@ -226,7 +1098,7 @@ class CustomFieldsBuilder(object):
                     raise ValidationError({ NON_FIELD_ERRORS: (_('A value for this custom field already exists'),) })
 
             def __str__(self):
-                return "%s: %s" % (self.custom_field.name, self.value)
+                return "%s: %s" % (self._get_custom_field().name, self.value)
 
         return CustomContentTypeFieldValue
 
@@ -242,36 +1114,220 @@ class CustomFieldsBuilder(object):
 
         _builder = self
 
-        class CustomManager(base_manager):
+        class CustomQuerySet(models.QuerySet):
+            def __init__(self, *args, **kwargs):
+                super(CustomQuerySet, self).__init__(*args, **kwargs)
+                self._custom_prefetch_fields = None
+                self._custom_prefetch_done = False
+
+            def prefetch_custom_values(self, *field_names):
+                """
+                Load the values of the given custom fields (or all of them if
+                none is specified) for every instance of this queryset with a
+                single additional query when the queryset is evaluated
+
+                :param field_names: names of the custom fields to prefetch
+                :return: a new queryset
+                """
+                _builder.check_values_model('prefetch_custom_values')
+                clone = self._clone()
+                clone._custom_prefetch_fields = field_names
+                return clone
+
+            def _clone(self, *args, **kwargs):
+                clone = super(CustomQuerySet, self)._clone(*args, **kwargs)
+                clone._custom_prefetch_fields = self._custom_prefetch_fields
+                return clone
+
+            def _fetch_all(self):
+                super(CustomQuerySet, self)._fetch_all()
+                if self._custom_prefetch_fields is not None and not self._custom_prefetch_done:
+                    _builder.prefetch_custom_values(self._result_cache,
+                                                    *self._custom_prefetch_fields)
+                    self._custom_prefetch_done = True
+
             def search(self, search_data, custom_args={}):
                 """
                 Search inside the custom fields for this model for any match
-                 of search_data and returns existing model instances
+                 of search_data and returns existing model instances. The
+                 whole search is compiled into a single query by the builder
+                 storage engine.
 
                 :param search_data:
                 :param custom_args:
                 :return:
                 """
-                query = None
-                lookups = (
-                    '%s__%s' % ('value_text', 'icontains'),
-                )
+                return _builder.storage_engine.search(self, search_data, custom_args)
+
+            def filter_custom(self, **kwargs):
+                """
+                Filter by custom field values, using the Django lookups syntax
+                with custom field names. Every lookup is applied to the values
+                column of the custom field data type and compiled into a
+                subquery, so it chains with any other queryset method::
+
+                  Example.objects.filter_custom(priority__gte=3, due_date__lt=today)
+
+                :param kwargs: lookups on custom field names
+                :return: a new queryset
+                """
+                return _builder.filter_queryset(self, **kwargs)
+
+            def with_custom_fields(self, *field_names):
+                """
+                Annotate each instance with the values of the given custom
+                fields, selected with a correlated subquery each. Annotations
+                are named like the custom fields, so they can be used in
+                ``order_by``, ``values`` and ``values_list``::
+
+                  Example.objects.with_custom_fields('priority').order_by('-priority')
+
+                :param field_names: names of the custom fields
+                :return: a new queryset
+                """
+                return _builder.annotate_queryset(self, *field_names)
+
+            def order_by_custom(self, *field_names):
+                """
+                Order by custom fields and model fields, custom field names are
+                recognized among the others and may be prefixed by ``-`` too.
+                Objects without a value for a custom field are always placed
+                after the others, whatever the database and the direction::
+
+                  Example.objects.order_by_custom('-priority', 'name')
+
+                Custom values are annotated named like the custom fields, see
+                ``with_custom_fields``.
+
+                :param field_names: names of custom fields and model fields
+                :return: a new queryset
+                """
+                content_type = ContentType.objects.get_for_model(self.model)
+                fields = dict((f.name, f) for f in _builder.get_fields_for_content_type(content_type))
+                queryset, ordering = self, []
+                for name in field_names:
+                    bare = name.lstrip('-')
+                    if bare not in fields:
+                        ordering.append(name)
+                        continue
+                    expression = _builder.get_value_expression(self.model, fields[bare])
+                    isnull = str('custard_%s_isnull' % bare)
+                    annotations = { isnull: IsNull(expression) }
+                    if bare not in queryset.query.annotations:
+                        annotations[str(bare)] = expression
+                    queryset = queryset.annotate(**annotations)
+                    ordering.extend([isnull, name])
+                return queryset.order_by(*ordering)
+
+            def keyset_custom(self, field_name, after=None, size=100):
+                """
+                Return a page of objects ordered by a custom field (prefixed
+                by ``-`` for descending order) and then by primary key, seeking
+                the page start on the values index instead of using an offset,
+                so deep pages cost like the first one. Objects without a value
+                come last. Each object gets the custom value as an attribute
+                named like the custom field::
+
+                  objects, key = Example.objects.keyset_custom('-priority')
+                  while key is not None:
+                      objects, key = Example.objects.keyset_custom('-priority', after=key)
+
+                :param field_name: name of the custom field
+                :param after: the key of the previous page, None for the first page
+                :param size: the number of objects in a page
+                :return: a tuple of the list of objects and the key of the next
+                         page (None for the last page)
+                """
+                _builder.check_values_model('keyset_custom')
+                descending = field_name.startswith('-')
+                name = field_name.lstrip('-')
                 content_type = ContentType.objects.get_for_model(self.model)
-                custom_args = dict({ 'content_type': content_type, 'searchable': True }, **custom_args)
-                custom_fields = dict((f.name, f) for f in _builder.fields_model_class.objects.filter(**custom_args))
-                for value_lookup in lookups:
-                    for key, f in custom_fields.items():
-                        found = _builder.values_model_class.objects.filter(**{ 'custom_field': f,
-                                                                               'content_type': content_type,
-                                                                               value_lookup: search_data })
-                        if found.count() > 0:
-                            if query is None:
-                                query = Q()
-                            query = query & Q(**{ str('%s__in' % self.model._meta.pk.name):
-                                                  [obj.object_id for obj in found] })
-                if query is None:
-                    return self.get_queryset().none()
-                return self.get_queryset().filter(query)
+                field = _builder.get_field_for_name(content_type, name)
+                column = _builder.value_column(field)
+                direction, op = ('-', 'lt') if descending else ('', 'gt')
+                values = _builder.values_model_class.objects.filter(custom_field=field,
+                                                                    content_type=content_type,
+                                                                    **{ str('%s__isnull' % column): False })
+                # orphan values and values of objects filtered out must not fill the page
+                values = values.filter(object_id__in=self.values('pk'))
+
+                page, key = [], None
+                if after is None or after[0] is not None:
+                    rows = values
+                    if after is not None:
+                        rows = rows.filter(Q(**{ str('%s__%s' % (column, op)): after[0] }) |
+                                           Q(**{ str(column): after[0], str('object_id__%s' % op): after[1] }))
+                    rows = list(rows.order_by(direction + column, direction + 'object_id')
+                                    .values_list('object_id', column)[:size])
+                    objects = self.in_bulk([object_id for object_id, value in rows])
+                    page = [(objects[object_id], value) for object_id, value in rows if object_id in objects]
+                    if len(rows) == size:
+                        # there may be more values, even if the page is short
+                        key = (rows[-1][1], rows[-1][0])
+                if key is None:
+                    rest = self.exclude(pk__in=values.values('object_id'))
+                    if after is not None and after[0] is None:
+                        rest = rest.filter(**{ str('pk__%s' % op): after[1] })
+                    rest = list(rest.order_by(direction + 'pk')[:size - len(page)])
+                    page.extend((obj, None) for obj in rest)
+                    if rest and len(page) == size:
+                        key = (None, rest[-1].pk)
+
+                for obj, value in page:
+                    setattr(obj, name, value)
+                return [obj for obj, value in page], key
+
+            def _resolve_custom_expressions(self, args, kwargs):
+                expressions = dict((arg.default_alias, arg) for arg in args)
+                expressions.update(kwargs)
+                return dict((str(alias), _builder.resolve_custom_expression(self.model, expression))
+                            for alias, expression in expressions.items())
+
+            def aggregate_custom(self, *args, **kwargs):
+                """
+                Aggregate custom field values in a single query, like
+                ``aggregate`` with custom field names in the expressions::
+
+                  Example.objects.aggregate_custom(Sum('priority'), last=Max('due_date'))
+
+                Custom values are selected with a correlated subquery on the
+                values column of the custom field data type, objects without
+                a value count as null.
+
+                :param args: aggregates, named by their default alias
+                :param kwargs: aggregates by name
+                :return: dict of names to aggregated values
+                """
+                return self.aggregate(**self._resolve_custom_expressions(args, kwargs))
+
+            def annotate_custom(self, *args, **kwargs):
+                """
+                Like ``annotate`` with custom field names in the expressions,
+                for example to aggregate custom values per group::
+
+                  Example.objects.values('category').annotate_custom(total=Sum('priority'))
+
+                :param args: aggregates, named by their default alias
+                :param kwargs: expressions by name
+                :return: a new queryset
+                """
+                return self.annotate(**self._resolve_custom_expressions(args, kwargs))
+
+            def bulk_set_custom_values(self, objects, rows):
+                """
+                Set custom values of many objects with a few queries, all
+                values are validated before anything is written
+
+                :param objects: model instances (already saved)
+                :param rows: for each object, a dict of custom field names
+                             (or custom fields) to values
+                :return:
+                """
+                content_type = ContentType.objects.get_for_model(self.model)
+                _builder.storage_engine.set_values(content_type, list(zip(objects, rows)))
+
+        class CustomManager(base_manager.from_queryset(CustomQuerySet)):
+            pass
 
         return CustomManager
 
@@ -297,43 +1353,91 @@ class CustomFieldsBuilder(object):
                 return _builder.fields_model_class.objects.filter(content_type=ContentType.objects.get_for_model(cls))
 
             def get_custom_fields(self):
-                """ Return a list of custom fields for this model """
+                """
+                Return a list of custom fields for this model, as a queryset.
+                Use ``builder.get_fields_for_content_type`` for the cached ones.
+                """
                 return _builder.fields_model_class.objects.filter(content_type=self._content_type)
 
+            @cached_property
+            def custom(self):
+                """ Custom values as attributes, see ``custard.accessor.CustomValuesAccessor`` """
+                return CustomValuesAccessor(_builder, self)
+
+            def _get_prefetched_custom_values(self, field):
+                """ Return the prefetched values cache if it holds the specified custom field """
+                cache = getattr(self, '_custom_values_cache', None)
+                if cache is not None:
+                    prefetched = self._custom_values_prefetched
+                    if prefetched is None or field.name in prefetched:
+                        return cache
+                return None
+
             def get_custom_value(self, field):
                 """ Get a value for a specified custom field """
-                return _builder.values_model_class.objects.get(custom_field=field,
-                                                               content_type=self._content_type,
-                                                               object_id=self.pk)
+                cache = self._get_prefetched_custom_values(field)
+                if cache is None:
+                    cache = _builder.get_object_values(self, [field])
+                try:
+                    return cache[field.pk]
+                except KeyError:
+                    raise _builder.values_model_class.DoesNotExist(
+                        "%s matching query does not exist." %
+                        _builder.values_model_class._meta.object_name)
 
             def set_custom_value(self, field, value):
                 """ Set a value for a specified custom field """
-                custom_value, created = \
-                    _builder.values_model_class.objects.get_or_create(custom_field=field,
-                                                                      content_type=self._content_type,
-                                                                      object_id=self.pk)
-                custom_value.value = value
-                custom_value.full_clean()
-                custom_value.save()
+                custom_value = _builder.storage_engine.set_value(self, field, value)
+                cache = self._get_prefetched_custom_values(field)
+                if cache is not None:
+                    cache[field.pk] = custom_value
+                if 'custom' in self.__dict__:
+                    self.custom._update([custom_value])
                 return custom_value
 
-            #def __getattr__(self, name):
-            #    """ Get a value for a specified custom field """
-            #    try:
-            #        obj = _builder.values_model_class.objects.get(custom_field__name=name,
-            #                                                      content_type=self._content_type,
-            #                                                      object_id=self.pk)
-            #        return obj.value
-            #    except ObjectDoesNotExist:
-            #        pass
-            #    return super(CustomModelMixin, self).__getattr__(name)
+            def set_custom_values(self, values):
+                """
+                Set values for many custom fields at once, validating them
+                before writing and saving them with a few queries
+
+                :param values: dict of custom field names (or custom fields) to values
+                :return: dict of custom field names to value instances
+                """
+                saved = _builder.storage_engine.set_values(self._content_type, [(self, values)])
+                saved = saved.get(self.pk, {})
+                cache = getattr(self, '_custom_values_cache', None)
+                if cache is not None:
+                    for value in saved.values():
+                        if self._get_prefetched_custom_values(value.custom_field) is not None:
+                            cache[value.custom_field_id] = value
+                if 'custom' in self.__dict__:
+                    self.custom._update(saved.values())
+                return dict((value.custom_field.name, value) for value in saved.values())
 
         return CustomModelMixin
 
+    def create_relation(self, **kwargs):
+        """
+        Create a generic relation to the custom values, to declare in the
+        custom field enabled model so its values are deleted together with
+        the objects, by ``Model.delete`` and ``QuerySet.delete`` too::
+
+          class Example(models.Model, builder.create_mixin()):
+              custom_values = builder.create_relation()
+
+        :param kwargs: other ``GenericRelation`` arguments
+        :return: the ``GenericRelation`` field
+        """
+        return GenericRelation('.'.join(self.values_model),
+                               content_type_field='content_type',
+                               object_id_field='object_id',
+                               **kwargs)
+
     #--------------------------------------------------------------------------
     def create_modelform(self, base_form=forms.ModelForm,
                          field_types=settings.CUSTOM_FIELD_TYPES,
-                         widget_types=settings.CUSTOM_WIDGET_TYPES):
+                         widget_types=settings.CUSTOM_WIDGET_TYPES,
+                         bake_custom_fields=False):
         """
         This creates the class that implements a ModelForm that knows about
         the custom fields
@@ -341,12 +1445,29 @@ class CustomFieldsBuilder(object):
         :param base_form:
         :param field_types:
         :param widget_types:
+        :param bake_custom_fields: reuse the custom form fields across form
+                                   instances, see ``get_baked_form_fields``
         :return:
         """
 
         _builder = self
+        _bake_custom_fields = bake_custom_fields
 
         class CustomFieldModelBaseForm(base_form):
+            bake_custom_fields = _bake_custom_fields
+
+            @classmethod
+            def _get_bake_key(cls, content_type):
+                """
+                The baked custom form fields depend on the custom fields and on
+                the methods building them, which are the same for the subclasses
+                generated on each request (like ``ModelAdmin.get_form`` does)
+                """
+                return (content_type.pk, _builder.fields_version) + tuple(
+                    six.get_unbound_function(getattr(cls, name))
+                    for name in ('get_fields_for_content_type', 'get_formfield_for_field',
+                                 'get_widget_for_field'))
+
             def __init__(self, *args, **kwargs):
                 """
                 Constructor
@@ -386,42 +1507,62 @@ class CustomFieldsBuilder(object):
                 """
                 content_type = self.get_content_type()
                 fields = self.get_fields_for_content_type(content_type)
+                values = {}
+                if self.instance and self.instance.pk:
+                    values = self.get_values_for_fields(fields,
+                                                        content_type,
+                                                        self.instance.pk)
+                baked = None
+                if self.bake_custom_fields:
+                    baked = _builder.get_baked_form_fields(self._get_bake_key(content_type))
                 for f in fields:
                     name = str(f.name)
                     initial = f.initial
-                    self.fields[name] = self.get_formfield_for_field(f)
-                    self.fields[name].is_custom = True
-                    self.fields[name].label = f.label
-                    self.fields[name].required = f.required
-                    self.fields[name].widget = self.get_widget_for_field(f)
-                    if self.instance and self.instance.pk:
-                        value = self.search_value_for_field(f,
-                                                            content_type,
-                                                            self.instance.pk)
-                        if len(value) > 0:
-                            initial = value[0].value
+                    if baked is not None:
+                        self.fields[name] = deepcopy(baked[name])
+                    else:
+                        self.fields[name] = self.get_formfield_for_field(f)
+                        self.fields[name].is_custom = True
+                        self.fields[name].label = f.label
+                        self.fields[name].required = f.required
+                        self.fields[name].widget = self.get_widget_for_field(f)
+                    if f.pk in values:
+                        initial = values[f.pk].value
                     self.fields[name].initial = self.initial[name] = initial
+                if self.bake_custom_fields and baked is None:
+                    _builder.set_baked_form_fields(self._get_bake_key(content_type),
+                                                   dict((str(f.name), deepcopy(self.fields[str(f.name)]))
+                                                        for f in fields))
 
             def save_custom_fields(self):
-                """ Perform save and validation over the custom fields """
+                """
+                Perform save and validation over the custom fields, existing
+                values are loaded at once then changed and new values are
+                written in bulk inside a transaction
+                """
                 if not self.instance.pk:
                     raise Exception("The model instance has not been saved. Have you called instance.save() ?")
 
                 content_type = self.get_content_type()
                 fields = self.get_fields_for_content_type(content_type)
+                existing = self.get_values_for_fields(fields,
+                                                      content_type,
+                                                      self.instance.pk)
+                created, updated = [], []
                 for f in fields:
                     name = str(f.name)
-                    fv = self.search_value_for_field(f,
-                                                     content_type,
-                                                     self.instance.pk)
-                    if len(fv) > 0:
-                        value = fv[0]
-                        value.value = self.cleaned_data[name]
+                    if f.pk in existing:
+                        value = existing[f.pk]
+                        if value.value != self.cleaned_data[name]:
+                            value.value = self.cleaned_data[name]
+                            updated.append(value)
                     else:
                         value = self.create_value_for_field(f,
                                                             self.instance.pk,
                                                             self.cleaned_data[name])
-                    value.save()
+                        value.content_type_id = f.content_type_id
+                        created.append(value)
+                _builder.storage_engine.write_values(self.instance, created, updated)
 
             def get_model(self):
                 """
@@ -475,7 +1616,7 @@ class CustomFieldsBuilder(object):
                     pass
                 elif field.data_type == CUSTOM_TYPE_BOOLEAN:
                     pass
-                field_type = import_class(field_types[field.data_type])
+                field_type = _builder.import_type(field_types[field.data_type])
                 return field_type(**field_attrs)
 
             def get_widget_for_field(self, field, attrs={}):
@@ -486,7 +1627,7 @@ class CustomFieldsBuilder(object):
                 :param attrs: attributes of widgets
                 :return: the widget instance
                 """
-                return import_class(widget_types[field.data_type])(**attrs)
+                return _builder.import_type(widget_types[field.data_type])(**attrs)
 
             def get_fields_for_content_type(self, content_type):
                 """
@@ -500,7 +1641,7 @@ class CustomFieldsBuilder(object):
                 :return: the custom field instances
                 """
 
-                return _builder.fields_model_class.objects.filter(content_type=content_type)
+                return _builder.get_fields_for_content_type(content_type)
 
             def search_value_for_field(self, field, content_type, object_id):
                 """
@@ -522,6 +1663,30 @@ class CustomFieldsBuilder(object):
                                                                   content_type=content_type,
                                                                   object_id=object_id)
 
+            def get_values_for_fields(self, fields, content_type, object_id):
+                """
+                This function will return the CustomFieldValue instances of an
+                object for the given fields, loading all of them at once from the
+                builder storage engine (with a single query by default). When
+                ``search_value_for_field`` is overridden, it's called once for
+                each field instead.
+
+                :param fields: the custom field instances
+                :param content_type: the content type instance
+                :param object_id: the object id the values are referring to
+                :return: dict of custom field primary keys to CustomFieldValue instances
+                """
+                values = {}
+                if six.get_unbound_function(type(self).search_value_for_field) is not \
+                   six.get_unbound_function(CustomFieldModelBaseForm.search_value_for_field):
+                    for f in fields:
+                        value = self.search_value_for_field(f, content_type, object_id)
+                        if len(value) > 0:
+                            values[f.pk] = value[0]
+                    return values
+
+                return _builder.get_object_values(self.instance, fields)
+
             def create_value_for_field(self, field, object_id, value):
                 """
                 Create a value for a given field of an object
@@ -556,9 +1721,100 @@ class CustomFieldsBuilder(object):
         _builder = self
 
         class CustomFieldModelBaseAdmin(base_admin):
+            custom_list_display = ()
+            custom_list_filter = ()
+            custom_ordering = ()
+
             def __init__(self, *args, **kwargs):
                 super(CustomFieldModelBaseAdmin, self).__init__(*args, **kwargs)
 
+            def get_custom_fields_by_name(self):
+                """ Return a dict of the custom fields of the model, keyed by name """
+                content_type = ContentType.objects.get_for_model(self.model)
+                return dict((f.name, f) for f in _builder.get_fields_for_content_type(content_type))
+
+            def get_queryset(self, request):
+                """
+                Annotate the changelist queryset with the values of the custom
+                fields in ``custom_list_display`` and ``custom_ordering``, so
+                they are selected by the same query loading the objects
+                """
+                queryset = super(CustomFieldModelBaseAdmin, self).get_queryset(request)
+                fields = self.get_custom_fields_by_name()
+                names = set(self.custom_list_display)
+                names.update(name.lstrip('-') for name in self.custom_ordering)
+                names = [name for name in names if name in fields]
+                if names:
+                    queryset = _builder.annotate_queryset(queryset, *names)
+                return queryset
+
+            def get_list_display(self, request):
+                list_display = super(CustomFieldModelBaseAdmin, self).get_list_display(request)
+                fields = self.get_custom_fields_by_name()
+                return list(list_display) + [self.get_custom_column(fields[name])
+                                             for name in self.custom_list_display
+                                             if name in fields]
+
+            def get_list_filter(self, request):
+                list_filter = super(CustomFieldModelBaseAdmin, self).get_list_filter(request)
+                fields = self.get_custom_fields_by_name()
+                return list(list_filter) + [self.get_custom_list_filter(fields[name])
+                                            for name in self.custom_list_filter
+                                            if name in fields]
+
+            def get_ordering(self, request):
+                ordering = super(CustomFieldModelBaseAdmin, self).get_ordering(request)
+                fields = self.get_custom_fields_by_name()
+                return [name for name in self.custom_ordering
+                        if name.lstrip('-') in fields] + list(ordering or ())
+
+            def get_custom_column(self, field):
+                """
+                Return a ``list_display`` callable showing the value of a
+                custom field, read from the queryset annotation
+
+                :param field: the custom field instance
+                :return: the callable
+                """
+                def column(obj):
+                    return getattr(obj, field.name, None)
+                column.__name__ = str(field.name)
+                column.short_description = field.label or field.name
+                column.admin_order_field = field.name
+                column.boolean = field.data_type == CUSTOM_TYPE_BOOLEAN
+                return column
+
+            def get_custom_list_filter(self, field):
+                """
+                Return a ``list_filter`` class filtering by the values of a
+                custom field, its choices are loaded with a single query
+
+                :param field: the custom field instance
+                :return: the ``SimpleListFilter`` subclass
+                """
+                column = _builder.value_column(field)
+                model_field = _builder.values_model_class._meta.get_field(column)
+
+                class CustomFieldListFilter(admin.SimpleListFilter):
+                    title = field.label or field.name
+                    parameter_name = 'custom_%s' % field.name
+
+                    def lookups(self, request, model_admin):
+                        values = _builder.values_model_class.objects \
+                            .filter(custom_field=field, **{ str('%s__isnull' % column): False }) \
+                            .order_by(column).values_list(column, flat=True).distinct()
+                        if field.data_type == CUSTOM_TYPE_BOOLEAN:
+                            return [(value, _('Yes') if value else _('No')) for value in values]
+                        return [(value, value) for value in values]
+
+                    def queryset(self, request, queryset):
+                        if self.value() is None:
+                            return queryset
+                        return _builder.filter_queryset(queryset, **{
+                            str(field.name): model_field.to_python(self.value()) })
+
+                return CustomFieldListFilter
+
             def save_model(self, request, obj, form, change):
                 obj.save()
                 if hasattr(form, 'save_custom_fields'):
@@ -1,15 +1,10 @@
 from __future__ import unicode_literals
-import sys
 from django.conf import settings as django_settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.functional import cached_property as settings_property
 
 
-#==============================================================================
-# Do not cache properties when in test mode
-if 'test' in sys.argv:
-    settings_property = property
-
-
 #==============================================================================
 # Constants
 CUSTOM_TYPE_TEXT     = 'text'
@@ -56,3 +51,11 @@ class LazySettingsDict(object):
 
 #==============================================================================
 settings = LazySettingsDict()
+
+
+#==============================================================================
+# Settings are cached, drop them when changed (like with override_settings)
+@receiver(setting_changed)
+def reset_settings(sender, setting, **kwargs):
+    if setting in ('CUSTOM_CONTENT_TYPES', 'CUSTOM_FIELD_TYPES', 'CUSTOM_WIDGET_TYPES'):
+        settings.__dict__.pop(setting, None)
@@ -0,0 +1,47 @@
+from __future__ import unicode_literals
+from django.db import models
+from django.db.models.expressions import Expression, Func
+
+
+#==============================================================================
+class CustomValue(Expression):
+    """
+    Select the value of a custom field for each row of a queryset, as a
+    correlated subquery on the values table. The outer table is looked up
+    when the query is compiled, so the expression keeps working when the
+    queryset is used as a subquery and its tables are renamed.
+    """
+
+    def __init__(self, values_model, custom_field, value_field):
+        """
+        :param values_model: the values model class
+        :param custom_field: the custom field instance
+        :param value_field: the values model field holding the custom field data type
+        """
+        super(CustomValue, self).__init__(output_field=value_field)
+        self.values_model = values_model
+        self.custom_field = custom_field
+        self.value_field = value_field
+
+    def as_sql(self, compiler, connection):
+        qn = connection.ops.quote_name
+        opts = self.values_model._meta
+        query = compiler.query
+        sql = 'SELECT custard_v.%s FROM %s custard_v WHERE custard_v.%s = %%s AND custard_v.%s = %s.%s' % (
+            qn(self.value_field.column),
+            qn(opts.db_table),
+            qn(opts.get_field('custom_field').column),
+            qn(opts.get_field('object_id').column),
+            compiler.quote_name_unless_alias(query.get_initial_alias()),
+            qn(query.get_meta().pk.column),
+        )
+        return '(%s)' % sql, [self.custom_field.pk]
+
+
+class IsNull(Func):
+    """ 1 when the expression is null, 0 otherwise, to sort nulls on any database """
+
+    template = 'CASE WHEN %(expressions)s IS NULL THEN 1 ELSE 0 END'
+
+    def __init__(self, expression, **extra):
+        super(IsNull, self).__init__(expression, output_field=models.IntegerField(), **extra)
@@ -0,0 +1,37 @@
+from __future__ import unicode_literals
+from importlib import import_module
+from django.apps import apps
+from django.core.management.base import CommandError
+
+from ..builder import CustomFieldsBuilder
+
+
+#==============================================================================
+def get_builder(model, path=None):
+    """
+    Return the builder of a model, either from a dotted path or looking for a
+    ``CustomFieldsBuilder`` named ``builder`` in the model module (model can
+    be None when the path is given)
+    """
+    if path:
+        module, _, name = path.rpartition('.')
+        try:
+            builder = getattr(import_module(module), name, None)
+        except ImportError as e:
+            raise CommandError(str(e))
+    else:
+        builder = getattr(import_module(model.__module__), 'builder', None)
+    if not isinstance(builder, CustomFieldsBuilder):
+        if model is None:
+            raise CommandError("No custom fields builder found at %s" % path)
+        raise CommandError("No custom fields builder found for %s.%s, use --builder" %
+                           (model._meta.app_label, model._meta.object_name))
+    return builder
+
+
+def get_model(label):
+    """ Return the model for an app_label.ModelName label """
+    try:
+        return apps.get_model(label)
+    except (LookupError, ValueError) as e:
+        raise CommandError(str(e))
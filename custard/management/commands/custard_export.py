@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+import io
+from django.core.management.base import BaseCommand
+
+from ...utils import EXPORT_FORMATS
+from .. import get_model, get_builder
+
+
+#==============================================================================
+class Command(BaseCommand):
+    help = "Export the objects of a model with their custom values as CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="The model to export, as app_label.ModelName")
+        parser.add_argument('--builder', default=None,
+                            help="Dotted path of the builder, defaults to the 'builder' "
+                                 "of the model module")
+        parser.add_argument('--format', default='csv', choices=sorted(EXPORT_FORMATS.keys()))
+        parser.add_argument('--output', default=None,
+                            help="The file to write, defaults to the standard output")
+        parser.add_argument('--fields', default='',
+                            help="Comma separated names of the custom fields to export, "
+                                 "defaults to all")
+        parser.add_argument('--model-fields', default='pk',
+                            help="Comma separated names of the model fields to export")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="How many objects are loaded in each query")
+
+    def handle(self, *args, **options):
+        model = get_model(options['model'])
+        builder = get_builder(model, options['builder'])
+        lines = builder.export_custom_values(model._default_manager.all(),
+                                             format=options['format'],
+                                             field_names=[f for f in options['fields'].split(',') if f],
+                                             model_fields=[f for f in options['model_fields'].split(',') if f],
+                                             chunk_size=options['chunk_size'])
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                for line in lines:
+                    output.write(line)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
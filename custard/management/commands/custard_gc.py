@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from .. import get_model, get_builder
+
+
+#==============================================================================
+class Command(BaseCommand):
+    help = "Delete the custom values whose object doesn't exist anymore"
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*',
+                            help="The models to check, as app_label.ModelName, defaults to all "
+                                 "the content types having values in the --builder values model")
+        parser.add_argument('--builder', default=None,
+                            help="Dotted path of the builder, defaults to the 'builder' "
+                                 "of each model module")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="How many values are checked in each query")
+        parser.add_argument('--sleep', type=float, default=0,
+                            help="Seconds to wait between chunks")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Only count the orphan values, without deleting them")
+        parser.add_argument('--include-stale', action='store_true', default=False,
+                            help="Delete all the values of the content types whose model doesn't "
+                                 "exist, they're skipped by default")
+
+    def handle(self, *args, **options):
+        if options['models']:
+            targets = []
+            for label in options['models']:
+                model = get_model(label)
+                targets.append((get_builder(model, options['builder']),
+                                ContentType.objects.get_for_model(model)))
+        elif options['builder']:
+            builder = get_builder(None, options['builder'])
+            content_type_ids = builder.values_model_class.objects.order_by() \
+                                      .values_list('content_type', flat=True).distinct()
+            targets = [(builder, content_type)
+                       for content_type in ContentType.objects.filter(pk__in=list(content_type_ids))]
+        else:
+            raise CommandError("Specify the models to check or a --builder")
+
+        verb = 'found' if options['dry_run'] else 'deleted'
+        for builder, content_type in targets:
+            if content_type.model_class() is None and not options['include_stale']:
+                self.stdout.write("%s.%s: skipped, the model doesn't exist (use --include-stale)" %
+                                  (content_type.app_label, content_type.model))
+                continue
+            count = builder.delete_orphan_values(content_type,
+                                                 chunk_size=options['chunk_size'],
+                                                 sleep=options['sleep'],
+                                                 dry_run=options['dry_run'],
+                                                 include_stale=options['include_stale'])
+            self.stdout.write("%s.%s: %d orphan values %s" %
+                              (content_type.app_label, content_type.model, count, verb))
@@ -0,0 +1,42 @@
+from __future__ import unicode_literals
+import io
+from django.core.management.base import BaseCommand
+from django.utils.encoding import force_text
+
+from ...utils import IMPORT_FORMATS
+from .. import get_model, get_builder
+
+
+#==============================================================================
+class Command(BaseCommand):
+    help = "Import custom values of the objects of a model from CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="The model to import values for, as app_label.ModelName")
+        parser.add_argument('input', help="The file to read")
+        parser.add_argument('--builder', default=None,
+                            help="Dotted path of the builder, defaults to the 'builder' "
+                                 "of the model module")
+        parser.add_argument('--format', default='csv', choices=sorted(IMPORT_FORMATS.keys()))
+        parser.add_argument('--id-column', default='pk',
+                            help="The column holding the object primary key")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="How many rows are validated and written at once")
+        parser.add_argument('--on-conflict', default='update', choices=('update', 'skip', 'error'),
+                            help="What to do with values already existing")
+
+    def handle(self, *args, **options):
+        model = get_model(options['model'])
+        builder = get_builder(model, options['builder'])
+        with io.open(options['input'], 'r', encoding='utf-8', newline='') as input:
+            result = builder.import_custom_values(model, IMPORT_FORMATS[options['format']](input),
+                                                  id_column=options['id_column'],
+                                                  batch_size=options['batch_size'],
+                                                  on_conflict=options['on_conflict'])
+        for number, errors in result['errors']:
+            for name, messages in sorted(errors.items()):
+                for message in messages:
+                    self.stderr.write("Row %d, %s: %s" % (number, name, force_text(message)))
+        self.stdout.write("%d created, %d updated, %d skipped, %d rows with errors" %
+                          (result['created'], result['updated'], result['skipped'],
+                           len(result['errors'])))
@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from .. import get_model, get_builder
+
+
+#==============================================================================
+class Command(BaseCommand):
+    help = "Rebuild the materialized tables of custom values which are stale"
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*',
+                            help="The materialized models, as app_label.ModelName, defaults to all "
+                                 "the models materialized by the --builder")
+        parser.add_argument('--builder', default=None,
+                            help="Dotted path of the builder, defaults to the 'builder' "
+                                 "of each model module")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="How many rows are inserted in each query")
+        parser.add_argument('--force', action='store_true', default=False,
+                            help="Rebuild the tables even if they're up to date")
+
+    def handle(self, *args, **options):
+        if options['models']:
+            tables = []
+            for label in options['models']:
+                model = get_model(label)
+                table = get_builder(model, options['builder']) \
+                    .get_materialized_table(ContentType.objects.get_for_model(model))
+                if table is None:
+                    raise CommandError("%s isn't materialized" % label)
+                tables.append(table)
+        elif options['builder']:
+            tables = list(get_builder(None, options['builder']).materialized_tables)
+        else:
+            raise CommandError("Specify the models to rebuild or a --builder")
+
+        for table in tables:
+            label = '%s.%s' % (table.content_type.app_label, table.content_type.model)
+            if not options['force'] and not table.is_stale():
+                self.stdout.write("%s: up to date" % label)
+                continue
+            table.rebuild(batch_size=options['batch_size'])
+            self.stdout.write("%s: %s rebuilt" % (label, table.db_table))
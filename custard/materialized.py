@@ -0,0 +1,227 @@
+from __future__ import unicode_literals
+from django.apps.registry import Apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models, connections, router, transaction
+from django.db.models.constants import LOOKUP_SEP
+from django.utils.functional import cached_property
+
+
+#==============================================================================
+class MaterializedTable(object):
+    """
+    A wide table holding the custom values of the objects of a model, with
+    one row per object and one indexed column per custom field, kept in sync
+    with the values table by the builder. Created with
+    ``CustomFieldsBuilder.materialize``.
+
+    When custom fields change the table becomes stale: it's not used nor
+    refreshed until ``rebuild`` is run again, for example by the
+    ``custard_materialize`` management command.
+    """
+
+    def __init__(self, builder, model, db_table=None, using=None):
+        """
+        :param builder: the ``CustomFieldsBuilder`` of the model
+        :param model: the model class whose custom values are materialized
+        :param db_table: the table name, defaults to the model table with a
+                         ``_custom`` suffix
+        :param using: the database alias, defaults to the router write database
+                      of the values model
+        """
+        self.builder = builder
+        self.model = model
+        self.db_table = db_table or '%s_custom' % model._meta.db_table
+        self._using = using
+        self._table_model = None
+        self._table_model_version = None
+        self._stale = None
+        self._stale_version = None
+
+    @cached_property
+    def content_type(self):
+        return ContentType.objects.get_for_model(self.model)
+
+    @property
+    def using(self):
+        return self._using or router.db_for_write(self.builder.values_model_class)
+
+    @staticmethod
+    def get_column(field):
+        """
+        Returns the table column of a custom field, named like the field
+        followed by its data type, so a data type change makes the table stale
+
+        :param field: the custom field instance
+        :return: the column name, like ``priority_integer``
+        """
+        return '%s_%s' % (field.name, field.data_type)
+
+    def get_table_model(self):
+        """
+        Returns an unmanaged model class mapping the wide table, with an
+        ``object_id`` primary key and a field named like each custom field.
+        The class is generated again when custom fields change, and it's kept
+        out of the project apps registry so it's never seen by migrations.
+
+        :return: the model class
+        :raise ImproperlyConfigured: when a custom field name can't be a field
+                                     of the table model
+        """
+        if self._table_model_version != self.builder.fields_version:
+            builder = self.builder
+            opts = self.model._meta
+            attrs = {
+                '__module__': self.__module__,
+                'Meta': type(str('Meta'), (object,), {
+                    'apps': Apps(),
+                    'app_label': opts.app_label,
+                    'db_table': self.db_table,
+                    'managed': False,
+                }),
+                'object_id': models.IntegerField(primary_key=True),
+            }
+            for field in builder.get_fields_for_content_type(self.content_type):
+                if field.name == 'object_id' or LOOKUP_SEP in field.name:
+                    raise ImproperlyConfigured("The custom field %s of %s can't be materialized, "
+                                               "rename it" % (field.name, opts.object_name))
+                column = builder.values_model_class._meta.get_field(builder.value_column(field))
+                name, path, args, kwargs = column.deconstruct()
+                kwargs.update({ 'db_index': True, 'null': True, 'db_column': self.get_column(field) })
+                attrs[str(field.name)] = column.__class__(*args, **kwargs)
+            self._table_model = type(str('%sCustomValues' % opts.object_name), (models.Model,), attrs)
+            self._table_model_version = builder.fields_version
+        return self._table_model
+
+    def get_rows(self, values):
+        """
+        Group value instances (ordered by object) into wide table instances
+
+        :param values: an iterable of value instances
+        :return: a generator of table model instances
+        """
+        table_model = self.get_table_model()
+        fields = dict((f.pk, f) for f in self.builder.get_fields_for_content_type(self.content_type))
+        row = None
+        for value in values:
+            field = fields.get(value.custom_field_id)
+            if field is None:
+                continue
+            if row is None or row.object_id != value.object_id:
+                if row is not None:
+                    yield row
+                row = table_model(object_id=value.object_id)
+            setattr(row, field.name, getattr(value, self.builder.value_column(field)))
+        if row is not None:
+            yield row
+
+    def is_stale(self):
+        """
+        Returns True if the table doesn't exist or its columns don't match the
+        current custom fields. The database is checked once per custom fields
+        change.
+        """
+        if self._stale_version != self.builder.fields_version:
+            connection = connections[self.using]
+            columns = None
+            with connection.cursor() as cursor:
+                if self.db_table in connection.introspection.table_names(cursor):
+                    columns = set(c.name for c in
+                                  connection.introspection.get_table_description(cursor, self.db_table))
+            expected = set(self.get_column(f)
+                           for f in self.builder.get_fields_for_content_type(self.content_type))
+            expected.add('object_id')
+            self._stale = columns != expected
+            self._stale_version = self.builder.fields_version
+        return self._stale
+
+    def _get_values(self):
+        return self.builder.values_model_class.objects.using(self.using) \
+                   .filter(content_type=self.content_type) \
+                   .order_by('object_id')
+
+    def create(self):
+        """ Create the table, without filling it """
+        with connections[self.using].schema_editor() as editor:
+            editor.create_model(self.get_table_model())
+
+    def drop(self):
+        """ Drop the table if it exists """
+        if self.db_table in connections[self.using].introspection.table_names():
+            with connections[self.using].schema_editor() as editor:
+                # the table may not match the current custom fields
+                editor.execute(editor.sql_delete_table % { 'table': editor.quote_name(self.db_table) })
+
+    def rebuild(self, batch_size=1000):
+        """
+        Create the table again with the current custom fields and fill it
+        with all the values of the content type, reading them by chunks.
+        It must be called once to create the table (usually from a data
+        migration), and again when custom fields of the content type change,
+        which is not done by the builder since it rewrites the whole table.
+
+        :param batch_size: how many rows are inserted per query
+        """
+        table_model = self.get_table_model()
+        with transaction.atomic(using=self.using):
+            self.drop()
+            self.create()
+            batch = []
+            for row in self.get_rows(self._get_values().iterator()):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    table_model.objects.using(self.using).bulk_create(batch)
+                    batch = []
+            if batch:
+                table_model.objects.using(self.using).bulk_create(batch)
+        self._stale = False
+        self._stale_version = self.builder.fields_version
+
+    def refresh(self, object_ids):
+        """
+        Update the rows of the given objects from the values table, in a
+        transaction locking the objects rows first, so concurrent refreshes
+        of an object run one after the other and the last one reads the last
+        values. It takes one query to lock the objects, one to read their
+        values, one to delete the rows and one to insert them again.
+
+        :param object_ids: primary keys of the objects to refresh
+        """
+        object_ids = list(set(object_ids))
+        if not object_ids:
+            return
+        table_model = self.get_table_model()
+        with transaction.atomic(using=self.using):
+            list(self.model._base_manager.using(self.using).select_for_update()
+                     .filter(pk__in=object_ids).values_list('pk', flat=True))
+            rows = list(self.get_rows(self._get_values().filter(object_id__in=object_ids)))
+            table_model.objects.using(self.using).filter(object_id__in=object_ids).delete()
+            table_model.objects.using(self.using).bulk_create(rows)
+
+    def filter_queryset(self, queryset, **kwargs):
+        """
+        Filter a queryset of the model with lookups on custom field names,
+        like ``CustomFieldsBuilder.filter_queryset``, through the wide table
+
+        :param queryset: the queryset to filter
+        :param kwargs: lookups on custom field names
+        :return: the filtered queryset
+        """
+        table_model = self.get_table_model()
+        rows = table_model.objects.using(self.using)
+        pk_in = str('%s__in' % queryset.model._meta.pk.name)
+        for lookup, value in kwargs.items():
+            name, _, value_lookup = lookup.partition(LOOKUP_SEP)
+            # raise FieldError on unknown custom fields
+            self.builder.get_field_for_name(self.content_type, name)
+            if value_lookup == 'isnull':
+                # objects without a row have a null value too
+                subquery = rows.filter(**{ str('%s__isnull' % name): False }).values('object_id')
+                if value:
+                    queryset = queryset.exclude(**{ pk_in: subquery })
+                else:
+                    queryset = queryset.filter(**{ pk_in: subquery })
+            else:
+                queryset = queryset.filter(**{ pk_in: rows.filter(**{ str(lookup): value })
+                                                          .values('object_id') })
+        return queryset
@@ -0,0 +1,76 @@
+from __future__ import unicode_literals
+import threading
+from contextlib import contextmanager
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+#==============================================================================
+if ContextVar is not None:
+    _memo = ContextVar('custard_memo', default=None)
+
+    def get_memo():
+        """ Returns the dict of the active memoization scope, or None """
+        return _memo.get()
+
+    def _set_memo(memo):
+        """ Sets the memo, returns the token to restore the previous one """
+        return _memo.set(memo)
+
+    def _reset_memo(token):
+        _memo.reset(token)
+
+else:
+    _local = threading.local()
+
+    def get_memo():
+        """ Returns the dict of the active memoization scope, or None """
+        return getattr(_local, 'memo', None)
+
+    def _set_memo(memo):
+        """ Sets the memo, returns the token to restore the previous one """
+        previous = get_memo()
+        _local.memo = memo
+        return previous
+
+    def _reset_memo(token):
+        _local.memo = token
+
+
+def start_memo():
+    """
+    Start a new memoization scope, discarding any memo left active in the
+    current thread or context, until ``clear_memo`` is called
+    """
+    _set_memo({})
+
+
+def clear_memo():
+    """ Discard the active memo, if any """
+    _set_memo(None)
+
+
+@contextmanager
+def memoize():
+    """
+    Memoize the custom values read by the builders until the block exits,
+    so the values of an object are loaded at most once. Values written
+    or deleted through the builders are discarded from the memo. Nested
+    blocks share the memo of the outermost one::
+
+      with memoize():
+          obj.get_custom_value(field)
+          obj.custom.priority  # no query
+    """
+    previous = get_memo()
+    if previous is not None:
+        yield previous
+        return
+    token = _set_memo({})
+    try:
+        yield get_memo()
+    finally:
+        _reset_memo(token)
@@ -0,0 +1,33 @@
+from __future__ import unicode_literals
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+from django.core.signals import request_finished
+
+from .memo import start_memo, clear_memo
+
+
+#==============================================================================
+class MemoizeMiddleware(MiddlewareMixin):
+    """
+    Memoize the custom values read during each request, see
+    ``custard.memo.memoize``. Each request starts with an empty memo, which
+    is discarded when the response is returned or, if a middleware skipped
+    ``process_response``, when the request is finished.
+    """
+
+    def process_request(self, request):
+        start_memo()
+
+    def process_response(self, request, response):
+        clear_memo()
+        return response
+
+
+def _clear_memo(sender, **kwargs):
+    clear_memo()
+
+request_finished.connect(_clear_memo, dispatch_uid='custard_clear_memo')
@@ -0,0 +1,326 @@
+from __future__ import unicode_literals
+import re
+import warnings
+from django.db import connections, router
+from django.db.models.expressions import RawSQL
+
+from .conf import CUSTOM_TYPE_TEXT
+
+
+#==============================================================================
+class RawSubquery(RawSQL):
+    """
+    Raw SQL subquery for ``__in`` lookups, the lookup adds the parentheses
+    """
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+#==============================================================================
+class SearchBackend(object):
+    """
+    Base search backend, used when no other backend is specified in the
+    builder. Matches values containing the search string, case insensitive,
+    which requires a sequential scan of the values table.
+    """
+
+    vendor = None
+
+    def setup(self, values_model, using='default'):
+        """
+        Create the database structures needed by the backend for a values
+        model, usually called from a data migration
+
+        :param values_model: the values model class
+        :param using: the database alias
+        """
+        pass
+
+    def teardown(self, values_model, using='default'):
+        """
+        Drop the database structures created by ``setup``
+
+        :param values_model: the values model class
+        :param using: the database alias
+        """
+        pass
+
+    def index_values(self, values):
+        """
+        Called after value instances (of the same values model) have been
+        saved, to update the index structures maintained by the backend
+
+        :param values: the saved value instances
+        """
+        pass
+
+    def unindex_values(self, values):
+        """
+        Called after value instances (of the same values model) have been
+        deleted, to update the index structures maintained by the backend
+
+        :param values: the deleted value instances
+        """
+        pass
+
+    def is_available(self, values):
+        """ Returns True if the backend can be used with the database of a values queryset """
+        return self.vendor is None or connections[values.db].vendor == self.vendor
+
+    def search(self, values, search_data):
+        """
+        Filter a values queryset, keeping the values matching search_data
+
+        :param values: the values queryset
+        :param search_data: the search string
+        :return: the filtered values queryset
+        """
+        return values.filter(value_text__icontains=search_data)
+
+    def _execute(self, statements, using):
+        with connections[using].cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def _quote(self, values_model, using):
+        quote_name = connections[using].ops.quote_name
+        opts = values_model._meta
+        return quote_name(opts.db_table), quote_name(opts.pk.column)
+
+
+#==============================================================================
+class SQLiteFTS5SearchBackend(SearchBackend):
+    """
+    Search backend using a SQLite FTS5 external content table, kept in sync
+    with the values table by triggers. Each word of the search string must
+    match the beginning of a word of the value.
+    """
+
+    vendor = 'sqlite'
+
+    def get_index_table(self, values_model):
+        return '%s_fts' % values_model._meta.db_table
+
+    def setup(self, values_model, using='default'):
+        quote_name = connections[using].ops.quote_name
+        table, pk = self._quote(values_model, using)
+        fts = self.get_index_table(values_model)
+        names = {
+            'table': table,
+            'pk': pk,
+            'fts': quote_name(fts),
+            'insert': quote_name('%s_ai' % fts),
+            'delete': quote_name('%s_ad' % fts),
+            'update': quote_name('%s_au' % fts),
+        }
+        self._execute([statement % names for statement in (
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts5("
+            "value_text, content=%(table)s, content_rowid=%(pk)s)",
+            "CREATE TRIGGER IF NOT EXISTS %(insert)s AFTER INSERT ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(rowid, value_text) VALUES (new.%(pk)s, new.value_text); END",
+            "CREATE TRIGGER IF NOT EXISTS %(delete)s AFTER DELETE ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, value_text) VALUES ('delete', old.%(pk)s, old.value_text); END",
+            "CREATE TRIGGER IF NOT EXISTS %(update)s AFTER UPDATE ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, value_text) VALUES ('delete', old.%(pk)s, old.value_text); "
+            "INSERT INTO %(fts)s(rowid, value_text) VALUES (new.%(pk)s, new.value_text); END",
+            "INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')",
+        )], using)
+
+    def teardown(self, values_model, using='default'):
+        quote_name = connections[using].ops.quote_name
+        fts = self.get_index_table(values_model)
+        self._execute([
+            "DROP TRIGGER IF EXISTS %s" % quote_name('%s_ai' % fts),
+            "DROP TRIGGER IF EXISTS %s" % quote_name('%s_ad' % fts),
+            "DROP TRIGGER IF EXISTS %s" % quote_name('%s_au' % fts),
+            "DROP TABLE IF EXISTS %s" % quote_name(fts),
+        ], using)
+
+    def get_match_query(self, search_data):
+        """ Returns the FTS5 query matching the words of search_data as prefixes """
+        words = re.findall(r'\w+', search_data, re.UNICODE)
+        return ' '.join('"%s"*' % word for word in words)
+
+    def search(self, values, search_data):
+        if not self.is_available(values):
+            return super(SQLiteFTS5SearchBackend, self).search(values, search_data)
+        match = self.get_match_query(search_data)
+        if not match:
+            return values.none()
+        fts = connections[values.db].ops.quote_name(self.get_index_table(values.model))
+        return values.filter(pk__in=RawSubquery('SELECT rowid FROM %s WHERE %s MATCH %%s' % (fts, fts),
+                                                [match]))
+
+
+#==============================================================================
+class PostgreSQLSearchBackend(SearchBackend):
+    """
+    Search backend using PostgreSQL full text search, through a GIN index
+    on the ``tsvector`` of the text values.
+    """
+
+    vendor = 'postgresql'
+
+    def __init__(self, config='simple'):
+        """
+        :param config: the text search configuration, like ``english``
+        """
+        if not re.match(r'^\w+$', config):
+            raise ValueError("Invalid text search configuration name: %s" % config)
+        self.config = config
+
+    def get_index_name(self, values_model):
+        return '%s_fts' % values_model._meta.db_table
+
+    def get_document(self):
+        return "to_tsvector('%s'::regconfig, COALESCE(value_text, ''))" % self.config
+
+    def setup(self, values_model, using='default'):
+        table, pk = self._quote(values_model, using)
+        index = connections[using].ops.quote_name(self.get_index_name(values_model))
+        self._execute([
+            "CREATE INDEX IF NOT EXISTS %s ON %s USING GIN ((%s))" % (index, table, self.get_document()),
+        ], using)
+
+    def teardown(self, values_model, using='default'):
+        index = connections[using].ops.quote_name(self.get_index_name(values_model))
+        self._execute([
+            "DROP INDEX IF EXISTS %s" % index,
+        ], using)
+
+    def search(self, values, search_data):
+        if not self.is_available(values):
+            return super(PostgreSQLSearchBackend, self).search(values, search_data)
+        table, pk = self._quote(values.model, values.db)
+        return values.filter(pk__in=RawSubquery("SELECT %s FROM %s WHERE %s @@ plainto_tsquery('%s'::regconfig, %%s)" %
+                                                (pk, table, self.get_document(), self.config),
+                                                [search_data]))
+
+
+#==============================================================================
+class NgramSearchBackend(SearchBackend):
+    """
+    Search backend for substring matches, using a side table of the n-grams of
+    the text values. Candidate objects holding all the n-grams of the search
+    string are selected through the index, then the exact case insensitive
+    containment is verified on them. Search strings shorter than ``n`` use the
+    default search.
+
+    The side table is maintained by the values model ``save`` and delete, and
+    by the builder bulk writes: values changed with ``QuerySet.update`` or raw
+    SQL must be indexed again with ``setup``. Until ``setup`` has created the
+    side table, values are not indexed and the default search is used, with a
+    warning.
+    """
+
+    def __init__(self, n=3):
+        """
+        :param n: the n-grams length
+        """
+        self.n = n
+        self._index_tables = {}
+
+    def get_index_table(self, values_model):
+        return '%s_ngrams' % values_model._meta.db_table
+
+    def has_index_table(self, values_model, using):
+        """
+        Returns True if the side table exists, checking the database once per
+        process (``setup`` and ``teardown`` update the result)
+        """
+        table = self.get_index_table(values_model)
+        key = (using, table)
+        if key not in self._index_tables:
+            exists = table in connections[using].introspection.table_names()
+            if not exists:
+                warnings.warn("The n-grams table %s doesn't exist, values are not indexed: "
+                              "run NgramSearchBackend.setup" % table, RuntimeWarning)
+            self._index_tables[key] = exists
+        return self._index_tables[key]
+
+    def get_ngrams(self, text):
+        """ Returns the set of n-grams of a text, case insensitive """
+        text = text.lower()
+        return set(text[i:i + self.n] for i in range(len(text) - self.n + 1))
+
+    def setup(self, values_model, using='default'):
+        quote_name = connections[using].ops.quote_name
+        table = self.get_index_table(values_model)
+        self._execute([
+            "CREATE TABLE IF NOT EXISTS %s (custom_field_id INTEGER NOT NULL, "
+            "object_id INTEGER NOT NULL, ngram VARCHAR(%d) NOT NULL)" % (quote_name(table), self.n),
+            "CREATE INDEX IF NOT EXISTS %s ON %s (ngram, custom_field_id, object_id)" %
+            (quote_name('%s_ngram' % table), quote_name(table)),
+            "CREATE INDEX IF NOT EXISTS %s ON %s (custom_field_id, object_id)" %
+            (quote_name('%s_value' % table), quote_name(table)),
+            "DELETE FROM %s" % quote_name(table),
+        ], using)
+        self._index_tables[(using, table)] = True
+        values = values_model._default_manager.using(using).filter(value_text__isnull=False)
+        batch = []
+        for value in values.iterator():
+            batch.append(value)
+            if len(batch) >= 1000:
+                self._index(values_model, batch, using)
+                batch = []
+        self._index(values_model, batch, using)
+
+    def teardown(self, values_model, using='default'):
+        quote_name = connections[using].ops.quote_name
+        self._execute([
+            "DROP TABLE IF EXISTS %s" % quote_name(self.get_index_table(values_model)),
+        ], using)
+        self._index_tables[(using, self.get_index_table(values_model))] = False
+
+    def index_values(self, values):
+        # values whose text didn't change since they were loaded are already indexed
+        values = [value for value in values
+                  if value._get_custom_field().data_type == CUSTOM_TYPE_TEXT and
+                  getattr(value, '_loaded_values', {}).get('value_text', self) != value.value_text]
+        if values:
+            values_model = values[0].__class__
+            using = values[0]._state.db or router.db_for_write(values_model)
+            if self.has_index_table(values_model, using):
+                self._index(values_model, values, using)
+                for value in values:
+                    if hasattr(value, '_loaded_values'):
+                        value._loaded_values['value_text'] = value.value_text
+
+    def unindex_values(self, values):
+        values = list(values)
+        if values:
+            values_model = values[0].__class__
+            using = values[0]._state.db or router.db_for_write(values_model)
+            if self.has_index_table(values_model, using):
+                self._unindex(values_model, values, using)
+
+    def _unindex(self, values_model, values, using):
+        table = connections[using].ops.quote_name(self.get_index_table(values_model))
+        with connections[using].cursor() as cursor:
+            cursor.executemany("DELETE FROM %s WHERE custom_field_id = %%s AND object_id = %%s" % table,
+                               [(value.custom_field_id, value.object_id) for value in values])
+
+    def _index(self, values_model, values, using):
+        if not values:
+            return
+        self._unindex(values_model, values, using)
+        rows = []
+        for value in values:
+            for ngram in self.get_ngrams(value.value_text or ''):
+                rows.append((value.custom_field_id, value.object_id, ngram))
+        if rows:
+            table = connections[using].ops.quote_name(self.get_index_table(values_model))
+            with connections[using].cursor() as cursor:
+                cursor.executemany("INSERT INTO %s (custom_field_id, object_id, ngram) VALUES (%%s, %%s, %%s)" % table,
+                                   rows)
+
+    def search(self, values, search_data):
+        ngrams = list(self.get_ngrams(search_data))
+        if not ngrams or not self.has_index_table(values.model, values.db):
+            return super(NgramSearchBackend, self).search(values, search_data)
+        table = connections[values.db].ops.quote_name(self.get_index_table(values.model))
+        candidates = RawSubquery("SELECT object_id FROM %s WHERE ngram IN (%s) "
+                                 "GROUP BY custom_field_id, object_id HAVING COUNT(DISTINCT ngram) = %d" %
+                                 (table, ', '.join(['%s'] * len(ngrams)), len(ngrams)),
+                                 ngrams)
+        return super(NgramSearchBackend, self).search(values.filter(object_id__in=candidates), search_data)
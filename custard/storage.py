@@ -0,0 +1,267 @@
+from __future__ import unicode_literals
+import json
+import re
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, router, transaction
+from django.db.models import Q
+
+from .conf import CUSTOM_TYPE_TEXT
+from .utils import bulk_update
+
+# characters with a special meaning in the regular expressions of SQLite
+# (Python re), PostgreSQL and MySQL, escaped with a backslash in all of them
+REGEX_SPECIAL_CHARS = re.compile(r'([\\.^$|?*+()\[\]{}])')
+
+
+def regex_escape(text):
+    """ Escape text to be matched literally by the database regular expressions """
+    return REGEX_SPECIAL_CHARS.sub(r'\\\1', text)
+
+
+#==============================================================================
+class StorageEngine(object):
+    """
+    Default storage engine, keeping each custom value in a row of the values
+    model. It's used when no other engine is specified in the builder, which
+    sets itself as the ``builder`` of the engine.
+    """
+
+    builder = None
+
+    # whether the builder values cache can be used with this engine
+    cache_values = True
+
+    # whether the values are rows of the values model, which the builder
+    # features querying the values table (filter_custom, with_custom_fields,
+    # materialize, import and export...) rely on
+    uses_values_model = True
+
+    def get_values(self, obj, fields):
+        """
+        Returns the values of the given custom fields of an object
+
+        :param obj: the model instance
+        :param fields: the custom field instances
+        :return: dict of custom field primary keys to value instances
+        """
+        fields = dict((f.pk, f) for f in fields)
+        values = {}
+        for value in self.builder.values_model_class.objects.filter(
+                content_type=ContentType.objects.get_for_model(obj),
+                object_id=obj.pk,
+                custom_field__in=list(fields.keys())):
+            value.custom_field = fields[value.custom_field_id]
+            values[value.custom_field_id] = value
+        return values
+
+    def set_value(self, obj, field, value):
+        """
+        Validate and save the value of a custom field of an object
+
+        :param obj: the model instance
+        :param field: the custom field instance
+        :param value: the value
+        :return: the value instance
+        """
+        try:
+            value = self.builder.clean_custom_value(field, value)
+        except ValidationError as e:
+            raise ValidationError({ field.name: e.messages })
+        custom_value, created = \
+            self.builder.values_model_class.objects.get_or_create(custom_field=field,
+                                                                  content_type=ContentType.objects.get_for_model(obj),
+                                                                  object_id=obj.pk)
+        custom_value.value = value
+        custom_value.full_clean()
+        custom_value.save()
+        return custom_value
+
+    def set_values(self, content_type, rows):
+        """
+        Validate and save the values of many custom fields of many objects,
+        nothing is saved when any value is not valid
+
+        :param content_type: content type of the objects
+        :param rows: list of ``(obj, {custom field or name: value})`` tuples
+        :return: dict of object ids to dicts of custom field ids to value instances
+        :raise ValidationError: when any value is not valid
+        """
+        values = {}
+        for obj, row in rows:
+            values.setdefault(obj.pk, {}).update(row)
+        return self.builder.save_custom_values(content_type, values)
+
+    def write_values(self, obj, created, updated):
+        """
+        Save value instances of an object, without validating them
+
+        :param obj: the model instance
+        :param created: new value instances, with ``content_type`` set
+        :param updated: changed value instances
+        """
+        self.builder.write_custom_values(created, updated)
+
+    def search(self, queryset, search_data, custom_args=None):
+        """
+        Filter a queryset, keeping the objects having a searchable custom
+        field matching search_data
+
+        :param queryset: the queryset
+        :param search_data: the search string
+        :param custom_args: lookups on the custom fields to search
+        :return: the filtered queryset
+        """
+        builder = self.builder
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        values = builder.values_model_class.objects.filter(content_type=content_type)
+        values = builder.search_backend.search(values, search_data)
+        if custom_args:
+            custom_args = dict({ 'searchable': True }, **custom_args)
+            values = values.filter(**dict(('custom_field__%s' % key, value)
+                                          for key, value in custom_args.items()))
+        else:
+            custom_fields = [f.pk for f in builder.get_fields_for_content_type(content_type)
+                             if f.searchable]
+            if not custom_fields:
+                return queryset.none()
+            values = values.filter(custom_field__in=custom_fields)
+
+        return queryset.filter(**{ str('%s__in' % queryset.model._meta.pk.name):
+                                   values.values('object_id') })
+
+
+#==============================================================================
+class JSONStorageEngine(StorageEngine):
+    """
+    Storage engine keeping all the custom values of an object as a JSON
+    document in a text field of the model itself, keyed by custom field
+    name, so reading them doesn't query the database. Value instances are
+    still returned, but they are never saved.
+    """
+
+    cache_values = False
+    uses_values_model = False
+
+    def __init__(self, field_name='custom_values'):
+        """
+        :param field_name: name of the model text field holding the values
+        """
+        self.field_name = field_name
+
+    def decode(self, data):
+        """ Returns the dict of custom field names to values of a JSON document """
+        if not data:
+            return {}
+        if isinstance(data, dict):
+            return dict(data)
+        return json.loads(data)
+
+    def load(self, obj):
+        """ Returns the dict of custom field names to values stored in an object """
+        return self.decode(getattr(obj, self.field_name))
+
+    def store(self, obj, data):
+        """ Replace the custom values stored in an object, without saving it """
+        setattr(obj, self.field_name, json.dumps(data, cls=DjangoJSONEncoder,
+                                                 ensure_ascii=False, sort_keys=True))
+
+    def save(self, objects):
+        """
+        Merge changed values into the documents stored in the database and
+        save them. The documents are read again with their rows locked, so
+        concurrent writes of other custom fields aren't lost.
+
+        :param objects: list of ``(obj, {custom field name: value})`` tuples
+        """
+        if not objects:
+            return
+        model = objects[0][0].__class__
+        using = router.db_for_write(model)
+        with transaction.atomic(using=using):
+            stored = dict(model._base_manager.using(using).select_for_update()
+                          .filter(pk__in=[obj.pk for obj, changes in objects])
+                          .values_list('pk', self.field_name))
+            for obj, changes in objects:
+                data = self.decode(stored.get(obj.pk))
+                data.update(changes)
+                self.store(obj, data)
+            bulk_update([obj for obj, changes in objects], [self.field_name])
+
+    def _create_value(self, obj, field, value):
+        builder = self.builder
+        custom_value = builder.values_model_class(custom_field=field,
+                                                  content_type_id=field.content_type_id,
+                                                  object_id=obj.pk)
+        column = builder.value_column(field)
+        setattr(custom_value, column,
+                builder.values_model_class._meta.get_field(column).to_python(value))
+        return custom_value
+
+    def get_values(self, obj, fields):
+        data = self.load(obj)
+        return dict((f.pk, self._create_value(obj, f, data[f.name])) for f in fields if f.name in data)
+
+    def set_value(self, obj, field, value):
+        content_type = ContentType.objects.get_for_model(obj)
+        return self.set_values(content_type, [(obj, { field: value })])[obj.pk][field.pk]
+
+    def set_values(self, content_type, rows):
+        builder = self.builder
+        values_model = builder.values_model_class
+        result, objects, errors = {}, {}, {}
+        for obj, row in rows:
+            data = objects[obj.pk][1] if obj.pk in objects else {}
+            for field, value in row.items():
+                if not isinstance(field, models.Model):
+                    field = builder.get_field_for_name(content_type, field)
+                try:
+                    value = builder.clean_custom_value(field, value)
+                except ValidationError as e:
+                    errors.setdefault(field.name, []).extend(e.messages)
+                    continue
+                custom_value = values_model(custom_field=field,
+                                            content_type_id=field.content_type_id,
+                                            object_id=obj.pk)
+                setattr(custom_value, builder.value_column(field), value)
+                data[field.name] = value
+                result.setdefault(obj.pk, {})[field.pk] = custom_value
+            objects[obj.pk] = (obj, data)
+
+        if errors:
+            raise ValidationError(errors)
+
+        self.save(list(objects.values()))
+        return result
+
+    def write_values(self, obj, created, updated):
+        self.save([(obj, dict((value._get_custom_field().name, value.value)
+                              for value in list(created) + list(updated)))])
+
+    def search(self, queryset, search_data, custom_args=None):
+        """
+        Filter a queryset, keeping the objects having a text searchable
+        custom field containing search_data, case insensitive, with a
+        regular expression on the JSON document. The expression only uses
+        the syntax shared by SQLite, PostgreSQL and MySQL.
+        """
+        builder = self.builder
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        if custom_args:
+            custom_args = dict({ 'searchable': True }, **custom_args)
+            fields = builder.fields_model_class.objects.filter(content_type=content_type,
+                                                               data_type=CUSTOM_TYPE_TEXT,
+                                                               **custom_args)
+        else:
+            fields = [f for f in builder.get_fields_for_content_type(content_type)
+                      if f.searchable and f.data_type == CUSTOM_TYPE_TEXT]
+        search = regex_escape(json.dumps(search_data, ensure_ascii=False)[1:-1])
+        query = Q()
+        for field in fields:
+            key = regex_escape(json.dumps(field.name, ensure_ascii=False))
+            # skip any character of the string value, escaped ones included
+            query |= Q(**{ str('%s__iregex' % self.field_name): r'%s: "([^"\\]|\\.)*%s' % (key, search) })
+        if not query:
+            return queryset.none()
+        return queryset.filter(query)
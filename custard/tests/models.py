@@ -1,6 +1,7 @@
 from django.db import models
 
 from custard.builder import CustomFieldsBuilder
+from custard.storage import JSONStorageEngine
 
 #==============================================================================
 builder = CustomFieldsBuilder('tests.CustomFieldsModel',
@@ -19,6 +20,7 @@ class SimpleModelWithoutManager(models.Model):
 
 class SimpleModelWithManager(models.Model, CustomMixinClass):
     name = models.CharField(max_length=255)
+    custom_values = builder.create_relation()
 
     objects = CustomManagerClass()
 
@@ -36,6 +38,22 @@ class CustomValuesModel(builder.create_values()):
     class Meta:
         app_label = 'tests'
 
+class VisibleManager(models.Manager):
+    def get_queryset(self):
+        return super(VisibleManager, self).get_queryset().filter(visible=True)
+
+class SimpleModelWithVisibility(models.Model):
+    name = models.CharField(max_length=255)
+    visible = models.BooleanField(default=True)
+
+    objects = VisibleManager()
+
+    class Meta:
+        app_label = 'tests'
+
+    def __str__(self):
+        return "%s" % self.name
+
 #==============================================================================
 builder_unique = CustomFieldsBuilder('tests.CustomFieldsUniqueModel',
                                      'tests.CustomValuesUniqueModel')
@@ -57,6 +75,25 @@ class CustomFieldsUniqueModel(builder_unique.create_fields()):
     class Meta:
         app_label = 'tests'
 
-class CustomValuesUniqueModel(builder_unique.create_values()):
+CustomValuesUniqueBase = builder_unique.create_values()
+
+class CustomValuesUniqueModel(CustomValuesUniqueBase):
+    class Meta(CustomValuesUniqueBase.Meta):
+        app_label = 'tests'
+
+#==============================================================================
+builder_json = CustomFieldsBuilder('tests.CustomFieldsModel',
+                                   'tests.CustomValuesModel',
+                                   storage_engine=JSONStorageEngine('custom_values'))
+
+class SimpleModelWithJSON(models.Model, builder_json.create_mixin()):
+    name = models.CharField(max_length=255)
+    custom_values = models.TextField(blank=True, default='')
+
+    objects = builder_json.create_manager()()
+
     class Meta:
         app_label = 'tests'
+
+    def __str__(self):
+        return "%s" % self.name
@@ -1,23 +1,37 @@
 from __future__ import unicode_literals
+import os
+import tempfile
+import warnings
 from datetime import date, time, datetime
 import django
-from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db.models import Q
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.core.exceptions import ValidationError, ObjectDoesNotExist, FieldError, ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Q, F, Sum, Count, Avg, Min, Max
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client
 from django.test.client import RequestFactory
 from django.test.utils import override_settings
+from django.utils import six
 
 from custard.conf import (CUSTOM_TYPE_TEXT, CUSTOM_TYPE_INTEGER,
                           CUSTOM_TYPE_BOOLEAN, CUSTOM_TYPE_FLOAT,
                           CUSTOM_TYPE_DATE, CUSTOM_TYPE_DATETIME,
                           CUSTOM_TYPE_TIME, settings)
 from custard.builder import CustomFieldsBuilder
-from custard.utils import import_class
+from custard.memo import memoize, get_memo
+from custard.middleware import MemoizeMiddleware, _clear_memo
+from custard.search import SQLiteFTS5SearchBackend, PostgreSQLSearchBackend, NgramSearchBackend
+from custard.utils import import_class, csv_rows
 
 from .models import (SimpleModelWithManager, SimpleModelWithoutManager,
     CustomFieldsModel, CustomValuesModel, builder,
-    SimpleModelUnique, CustomFieldsUniqueModel, CustomValuesUniqueModel, builder_unique)
+    SimpleModelUnique, CustomFieldsUniqueModel, CustomValuesUniqueModel, builder_unique,
+    SimpleModelWithJSON, builder_json, SimpleModelWithVisibility)
 
 
 #==============================================================================
@@ -101,6 +115,15 @@ class CustomModelsTestCase(TestCase):
     def test_import_class(self):
         self.assertEqual(import_class('custard.builder.CustomFieldsBuilder'), CustomFieldsBuilder)
 
+    def test_import_type(self):
+        builder2 = CustomFieldsBuilder('tests.CustomFieldsModel', 'tests.CustomValuesModel')
+        self.assertEqual(builder2.import_type('django.forms.fields.CharField'), django.forms.fields.CharField)
+        self.assertIn('django.forms.fields.CharField', builder2._types_cache)
+        with self.settings(CUSTOM_FIELD_TYPES={CUSTOM_TYPE_TEXT: 'django.forms.fields.EmailField'}):
+            self.assertNotIn('django.forms.fields.CharField', builder2._types_cache)
+            self.assertEqual(settings.CUSTOM_FIELD_TYPES[CUSTOM_TYPE_TEXT], 'django.forms.fields.EmailField')
+        self.assertEqual(settings.CUSTOM_FIELD_TYPES[CUSTOM_TYPE_TEXT], 'django.forms.fields.CharField')
+
     def test_model_repr(self):
         self.assertEqual(repr(self.cf), "<CustomFieldsModel: text_field>")
 
@@ -142,6 +165,151 @@ class CustomModelsTestCase(TestCase):
 
         val.delete()
 
+    def test_fields_cache(self):
+        builder.invalidate_fields()
+        with self.assertNumQueries(1):
+            self.assertIn(self.cf, builder.get_fields_for_content_type(self.simple_with_manager_ct))
+            self.assertEqual(8, len(builder.get_fields_for_content_type(self.simple_with_manager_ct)))
+
+        # the model methods still return querysets
+        self.assertEqual([self.cf], list(self.obj.get_custom_fields().filter(name='text_field')))
+        self.assertEqual([self.cf3], list(SimpleModelWithManager.get_model_custom_fields()
+                                                                 .filter(data_type=CUSTOM_TYPE_INTEGER)))
+
+        cf = CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                              name='new_field',
+                                              label="New field",
+                                              data_type=CUSTOM_TYPE_TEXT)
+        self.assertIn(cf, builder.get_fields_for_content_type(self.simple_with_manager_ct))
+
+        cf.delete()
+        self.assertNotIn(cf, builder.get_fields_for_content_type(self.simple_with_manager_ct))
+
+    def test_prefetch_custom_values(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        CustomValuesModel.objects.create(custom_field=self.cf,
+                                         object_id=self.obj.pk,
+                                         value="abcdefg").save()
+        CustomValuesModel.objects.create(custom_field=self.cf3,
+                                         object_id=self.obj.pk,
+                                         value=42).save()
+        CustomValuesModel.objects.create(custom_field=self.cf,
+                                         object_id=newobj.pk,
+                                         value="hijklmn").save()
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(2):
+            objs = list(SimpleModelWithManager.objects.prefetch_custom_values().order_by('pk'))
+            self.assertEqual("abcdefg", objs[0].get_custom_value(self.cf).value)
+            self.assertEqual(42, objs[0].get_custom_value(self.cf3).value)
+            self.assertEqual("hijklmn", objs[1].get_custom_value(self.cf).value)
+            with self.assertRaises(ObjectDoesNotExist):
+                objs[1].get_custom_value(self.cf3)
+
+        with self.assertNumQueries(2):
+            objs = list(SimpleModelWithManager.objects.filter(pk=self.obj.pk)
+                                                      .prefetch_custom_values('text_field'))
+            self.assertEqual("abcdefg", objs[0].get_custom_value(self.cf).value)
+
+        # not prefetched fields still hit the database
+        with self.assertNumQueries(1):
+            val = objs[0].get_custom_value(self.cf3)
+        self.assertEqual(42, val.value)
+
+        objs[0].set_custom_value(self.cf, "opqrstu")
+        with self.assertNumQueries(0):
+            self.assertEqual("opqrstu", objs[0].get_custom_value(self.cf).value)
+
+    def test_with_custom_fields(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        lastobj = SimpleModelWithManager.objects.create(name='last simple')
+        self.obj.set_custom_values({ 'int_field': 5, 'date_field': date(2015, 1, 1) })
+        newobj.set_custom_values({ 'int_field': 1, 'date_field': date(2015, 6, 1) })
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(1):
+            objs = list(SimpleModelWithManager.objects.with_custom_fields('int_field', 'date_field')
+                                                      .order_by('int_field', 'pk'))
+        self.assertEqual([lastobj, newobj, self.obj], objs)
+        self.assertEqual([None, 1, 5], [o.int_field for o in objs])
+        self.assertEqual([None, date(2015, 6, 1), date(2015, 1, 1)], [o.date_field for o in objs])
+
+        rows = SimpleModelWithManager.objects.with_custom_fields('int_field') \
+                                             .filter(int_field__gte=1) \
+                                             .order_by('-int_field') \
+                                             .values_list('name', 'int_field')
+        self.assertEqual([('old test', 5), ('new simple', 1)], list(rows))
+
+        # annotated querysets can be used as subqueries, where tables are renamed
+        annotated = SimpleModelWithManager.objects.with_custom_fields('int_field').filter(int_field=5)
+        values = CustomValuesModel.objects.filter(object_id__in=annotated.values('pk'))
+        self.assertEqual(set([self.obj.pk]), set(values.values_list('object_id', flat=True)))
+        first = SimpleModelWithManager.objects.order_by_custom('int_field').values('pk')[:1]
+        self.assertEqual([self.obj, lastobj],
+                         list(SimpleModelWithManager.objects.exclude(pk__in=first).order_by('pk')))
+
+        with self.assertRaises(FieldError):
+            SimpleModelWithManager.objects.with_custom_fields('unknown_field')
+
+    def test_set_custom_values(self):
+        self.obj.set_custom_value(self.cf, "abcdefg")
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(6):
+            # select, savepoint, insert, select pks, update, release
+            values = self.obj.set_custom_values({ 'text_field': "hijklmn",
+                                                  'int_field': "42",
+                                                  self.cf6: date(2015, 1, 1) })
+        self.assertEqual(42, values['int_field'].value)
+        self.assertEqual("hijklmn", self.obj.get_custom_value(self.cf).value)
+        self.assertEqual(42, self.obj.get_custom_value(self.cf3).value)
+        self.assertEqual(date(2015, 1, 1), self.obj.get_custom_value(self.cf6).value)
+
+        # created values get their primary key, saving them again doesn't insert a row
+        self.assertIsNotNone(values['int_field'].pk)
+        value = self.obj.get_custom_value(self.cf3)
+        value.value = 43
+        value.save()
+        self.assertEqual(1, CustomValuesModel.objects.filter(custom_field=self.cf3,
+                                                             object_id=self.obj.pk).count())
+        self.assertEqual(43, CustomValuesModel.objects.get(pk=value.pk).value)
+
+        with self.assertRaises(ValidationError):
+            self.obj.set_custom_values({ 'text_field': "opqrstu",
+                                         'int_field': "not an integer" })
+        self.assertEqual("hijklmn", self.obj.get_custom_value(self.cf).value)
+
+        with self.assertRaises(FieldError):
+            self.obj.set_custom_values({ 'unknown_field': 1 })
+
+        # same validation as imported values
+        CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                         name='limited_field',
+                                         label="Limited field",
+                                         data_type=CUSTOM_TYPE_INTEGER,
+                                         min_value=0,
+                                         max_value=10)
+        with self.assertRaises(ValidationError) as cm:
+            SimpleModelWithManager.objects.bulk_set_custom_values([self.obj], [{ 'limited_field': 11,
+                                                                                'another_text_field': '' }])
+        self.assertEqual(set(['limited_field', 'another_text_field']), set(cm.exception.message_dict.keys()))
+        self.assertEqual(10, self.obj.set_custom_values({ 'limited_field': '10' })['limited_field'].value)
+
+    def test_bulk_set_custom_values(self):
+        objs = [SimpleModelWithManager.objects.create(name='obj %d' % i) for i in range(10)]
+        objs[0].set_custom_value(self.cf, "existing")
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(6):
+            SimpleModelWithManager.objects.bulk_set_custom_values(
+                objs, [{ 'text_field': 'text %d' % i, 'int_field': i } for i in range(10)])
+
+        for i, obj in enumerate(SimpleModelWithManager.objects.filter(pk__in=[o.pk for o in objs])
+                                                              .prefetch_custom_values()
+                                                              .order_by('pk')):
+            self.assertEqual('text %d' % i, obj.get_custom_value(self.cf).value)
+            self.assertEqual(i, obj.get_custom_value(self.cf3).value)
+
     def test_field_model_clean(self):
         cf = CustomFieldsUniqueModel.objects.create(content_type=self.simple_unique,
                                                     name='xxx',
@@ -257,6 +425,19 @@ class CustomModelsTestCase(TestCase):
         self.assertEqual(val.value_text, "qwertyuiop")
         self.assertEqual(val.value, "qwertyuiop")
 
+    def test_value_accessor_uses_fields_cache(self):
+        self.obj.set_custom_values({ 'text_field': "abcdefg",
+                                     'int_field': 42 })
+        with self.assertNumQueries(1):
+            values = dict((v.custom_field_id, v) for v in CustomValuesModel.objects.all())
+        with self.assertNumQueries(0):
+            self.assertEqual("abcdefg", values[self.cf.pk].value)
+            self.assertEqual(42, values[self.cf3.pk].value)
+            self.assertEqual("text_field: abcdefg", str(values[self.cf.pk]))
+            values[self.cf3.pk].value = 43
+        values[self.cf3.pk].save()
+        self.assertEqual(43, self.obj.get_custom_value(self.cf3).value)
+
     def test_value_search(self):
         newobj = SimpleModelWithManager.objects.create(name='new simple')
         newobj.save()
@@ -299,6 +480,175 @@ class CustomModelsTestCase(TestCase):
         qs2 = SimpleModelWithManager.objects.search("67890")
         self.assertQuerysetEqual(qs2, [])
 
+    def test_value_search_single_query(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        CustomValuesModel.objects.create(custom_field=self.cf,
+                                         object_id=self.obj.pk,
+                                         value="xxx-needle").save()
+        other = CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                                 name='other_text_field',
+                                                 label="Other text field",
+                                                 data_type=CUSTOM_TYPE_TEXT)
+        CustomValuesModel.objects.create(custom_field=other,
+                                         object_id=newobj.pk,
+                                         value="needle-yyy").save()
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(1):
+            qs = SimpleModelWithManager.objects.search("needle")
+            self.assertQuerysetEqual(qs, [repr(self.obj), repr(newobj)], ordered=False)
+
+        qs = SimpleModelWithManager.objects.filter(name='new simple').search("needle")
+        self.assertQuerysetEqual(qs, [repr(newobj)])
+
+        qs = SimpleModelWithManager.objects.search("needle", custom_args={ 'name': 'text_field' })
+        self.assertQuerysetEqual(qs, [repr(self.obj)])
+
+    def test_filter_custom(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        self.obj.set_custom_value(self.cf3, 1)
+        self.obj.set_custom_value(self.cf6, date(2015, 1, 1))
+        newobj.set_custom_value(self.cf3, 5)
+        newobj.set_custom_value(self.cf6, date(2015, 6, 1))
+        newobj.set_custom_value(self.cf, "abcdefg")
+
+        qs = SimpleModelWithManager.objects.filter_custom(int_field__gte=3)
+        self.assertQuerysetEqual(qs, [repr(newobj)])
+
+        qs = SimpleModelWithManager.objects.filter_custom(int_field=1)
+        self.assertQuerysetEqual(qs, [repr(self.obj)])
+
+        qs = SimpleModelWithManager.objects.filter_custom(int_field__lt=10,
+                                                          date_field__lt=date(2015, 3, 1))
+        self.assertQuerysetEqual(qs, [repr(self.obj)])
+
+        qs = SimpleModelWithManager.objects.filter(name='old test').filter_custom(int_field__gte=3)
+        self.assertQuerysetEqual(qs, [])
+
+        qs = SimpleModelWithManager.objects.filter_custom(text_field__isnull=True)
+        self.assertQuerysetEqual(qs, [repr(self.obj)])
+
+        qs = SimpleModelWithManager.objects.filter_custom(text_field__isnull=False)
+        self.assertQuerysetEqual(qs, [repr(newobj)])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(1, SimpleModelWithManager.objects.filter_custom(text_field__icontains='CDE').count())
+
+        with self.assertRaises(FieldError):
+            SimpleModelWithManager.objects.filter_custom(unknown_field=1)
+
+    def test_value_search_fts5_backend(self):
+        backend = SQLiteFTS5SearchBackend()
+        backend.setup(CustomValuesModel)
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        self.obj.set_custom_values({ 'text_field': "the quick brown fox",
+                                     'another_text_field': "jumps over" })
+        newobj.set_custom_values({ 'text_field': "the lazy dog" })
+
+        default_backend = builder.search_backend
+        builder.search_backend = backend
+        try:
+            qs = SimpleModelWithManager.objects.search("qui")
+            self.assertQuerysetEqual(qs, [repr(self.obj)])
+
+            qs = SimpleModelWithManager.objects.search("the")
+            self.assertQuerysetEqual(qs, [repr(self.obj), repr(newobj)], ordered=False)
+
+            qs = SimpleModelWithManager.objects.search("LAZY dog")
+            self.assertQuerysetEqual(qs, [repr(newobj)])
+
+            qs = SimpleModelWithManager.objects.search("jumps")
+            self.assertQuerysetEqual(qs, [])
+
+            newobj.set_custom_value(self.cf, "the quick cat")
+            qs = SimpleModelWithManager.objects.search("quick")
+            self.assertQuerysetEqual(qs, [repr(self.obj), repr(newobj)], ordered=False)
+
+            qs = SimpleModelWithManager.objects.search("\"*")
+            self.assertQuerysetEqual(qs, [])
+
+            # fallback on other databases
+            self.assertTrue(PostgreSQLSearchBackend().search(CustomValuesModel.objects.all(), "uick c").exists())
+        finally:
+            builder.search_backend = default_backend
+            backend.teardown(CustomValuesModel)
+
+    def test_value_search_ngram_backend(self):
+        backend = NgramSearchBackend()
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        self.obj.set_custom_values({ 'text_field': "SKU-000ASDF-123",
+                                     'another_text_field': "XYZ-999" })
+        backend.setup(CustomValuesModel)
+
+        default_backend = builder.search_backend
+        builder.search_backend = backend
+        try:
+            newobj.set_custom_values({ 'text_field': "sku-000qwer-456",
+                                       'int_field': 3 })
+
+            qs = SimpleModelWithManager.objects.search("0asdf-")
+            self.assertQuerysetEqual(qs, [repr(self.obj)])
+
+            qs = SimpleModelWithManager.objects.search("sku-000")
+            self.assertQuerysetEqual(qs, [repr(self.obj), repr(newobj)], ordered=False)
+
+            qs = SimpleModelWithManager.objects.search("z-99")
+            self.assertQuerysetEqual(qs, [])
+
+            # ngrams found, but not in sequence
+            qs = SimpleModelWithManager.objects.search("123-sku")
+            self.assertQuerysetEqual(qs, [])
+
+            # short search strings fall back to default search
+            qs = SimpleModelWithManager.objects.search("we")
+            self.assertQuerysetEqual(qs, [repr(newobj)])
+
+            value = newobj.get_custom_value(self.cf)
+            value.value = "sku-000zxcv-789"
+            value.save()
+            self.assertQuerysetEqual(SimpleModelWithManager.objects.search("qwer"), [])
+            self.assertQuerysetEqual(SimpleModelWithManager.objects.search("zxcv"), [repr(newobj)])
+
+            CustomValuesModel.objects.filter(object_id=newobj.pk).delete()
+            self.assertQuerysetEqual(SimpleModelWithManager.objects.search("sku"), [repr(self.obj)])
+            cursor = connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM %s WHERE object_id = %%s" % backend.get_index_table(CustomValuesModel),
+                           [newobj.pk])
+            self.assertEqual(0, cursor.fetchone()[0])
+        finally:
+            builder.search_backend = default_backend
+            backend.teardown(CustomValuesModel)
+
+    def test_value_search_ngram_backend_index_table(self):
+        backend = NgramSearchBackend()
+        default_backend = builder.search_backend
+        builder.search_backend = backend
+        try:
+            # without setup values are saved and searched, with a warning
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                self.obj.set_custom_values({ 'text_field': "SKU-000ASDF-123" })
+                self.obj.set_custom_values({ 'text_field': "SKU-000ASDF-456" })
+            self.assertEqual(1, len(caught))
+            self.assertQuerysetEqual(SimpleModelWithManager.objects.search("asdf-456"), [repr(self.obj)])
+
+            backend.setup(CustomValuesModel)
+            self.assertQuerysetEqual(SimpleModelWithManager.objects.search("asdf-456"), [repr(self.obj)])
+
+            # unchanged text values are not indexed again
+            value = self.obj.get_custom_value(self.cf)
+            with self.assertNumQueries(1):
+                value.save()
+            value.value = "SKU-000QWER-789"
+            with self.assertNumQueries(3):
+                value.save()
+            with self.assertNumQueries(1):
+                value.save()
+            self.assertQuerysetEqual(SimpleModelWithManager.objects.search("qwer"), [repr(self.obj)])
+        finally:
+            builder.search_backend = default_backend
+            backend.teardown(CustomValuesModel)
+
     def test_get_formfield_for_field(self):
         with self.settings(CUSTOM_FIELD_TYPES={CUSTOM_TYPE_TEXT: 'django.forms.fields.EmailField'}):
             builder2 = CustomFieldsBuilder('tests.CustomFieldsModel', 'tests.CustomValuesModel')
@@ -368,9 +718,724 @@ class CustomModelsTestCase(TestCase):
         #self.assertInHTML(TestForm.custom_description, form.as_p())
         #self.assertInHTML(TestForm.custom_classes, form.as_p())
 
+    def test_form_initial_single_query(self):
+        self.obj.set_custom_values({ 'text_field': "abcdefg",
+                                     'int_field': 42 })
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(1):
+            form = SimpleModelWithManagerForm(instance=self.obj)
+        self.assertEqual("abcdefg", form.initial['text_field'])
+        self.assertEqual(42, form.initial['int_field'])
+        self.assertEqual(None, form.initial['float_field'])
+
+        class SlowForm(SimpleModelWithManagerForm):
+            def search_value_for_field(self, field, content_type, object_id):
+                return CustomValuesModel.objects.filter(custom_field=field,
+                                                        content_type=content_type,
+                                                        object_id=object_id)
+
+        form = SlowForm(instance=self.obj)
+        self.assertEqual("abcdefg", form.initial['text_field'])
+        self.assertEqual(42, form.initial['int_field'])
+
+    def test_form_save_bulk(self):
+        self.obj.set_custom_values({ 'text_field': "abcdefg",
+                                     'int_field': 42 })
+        data = { 'name': 'xxx',
+                 'text_field': 'hijklmn',
+                 'another_text_field': 'opqrstu',
+                 'int_field': '42' }
+        form = SimpleModelWithManagerForm(data, instance=self.obj)
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(6):
+            # select, savepoint, insert, select pks, update, release
+            form.save_custom_fields()
+        self.assertEqual('hijklmn', self.obj.get_custom_value(self.cf).value)
+        self.assertEqual('opqrstu', self.obj.get_custom_value(self.cf2).value)
+        self.assertEqual(42, self.obj.get_custom_value(self.cf3).value)
+        self.assertEqual(None, self.obj.get_custom_value(self.cf5).value)
+        self.assertEqual(8, CustomValuesModel.objects.filter(object_id=self.obj.pk).count())
+
+    def test_form_bake_custom_fields(self):
+        built = []
+
+        class BakedForm(builder.create_modelform(bake_custom_fields=True)):
+            class Meta:
+                fields = '__all__'
+                model = SimpleModelWithManager
+
+            def get_formfield_for_field(self, field):
+                built.append(field.name)
+                return super(BakedForm, self).get_formfield_for_field(field)
+
+        class SimpleModelAdmin(builder.create_modeladmin()):
+            form = BakedForm
+
+        modeladmin = SimpleModelAdmin(SimpleModelWithManager, AdminSite())
+        request = self.factory.get('/')
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+
+        self.obj.set_custom_value(self.cf, "abcdefg")
+        form = modeladmin.get_form(request, self.obj)(instance=self.obj)
+        self.assertEqual(8, len(built))
+        self.assertEqual("abcdefg", form.initial['text_field'])
+
+        # admin generates a new form class per request, the baked fields are reused
+        form_class = modeladmin.get_form(request, self.obj)
+        self.assertIsNot(form_class, type(form))
+        form = form_class(instance=self.obj)
+        self.assertEqual(8, len(built))
+        self.assertEqual("abcdefg", form.initial['text_field'])
+        self.assertTrue(form.fields['text_field'].is_custom)
+        self.assertNotIn('text_field', form_class.base_fields)
+        self.assertIsNot(form.fields['text_field'], form_class(instance=self.obj).fields['text_field'])
+        self.assertEqual(None, BakedForm().initial['text_field'])
+        self.assertEqual(8, len(built))
+
+        # a change in custom fields bakes the fields again
+        CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                         name='new_field',
+                                         label="New field",
+                                         data_type=CUSTOM_TYPE_TEXT)
+        form = BakedForm(instance=self.obj)
+        self.assertEqual(17, len(built))
+        self.assertIn('new_field', form.fields)
+        form = modeladmin.get_form(request, self.obj)(data={ 'name': 'xxx', 'another_text_field': 'yyy' },
+                                                      instance=self.obj)
+        self.assertEqual(17, len(built))
+        self.assertIn('new_field', form.fields)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertEqual("yyy", self.obj.get_custom_value(self.cf2).value)
+
     def test_admin(self):
         modeladmin_class = builder.create_modeladmin()
         #c = Client()
         #if c.login(username='fred', password='secret'):
         #    response = c.get('/admin/', follow=True)
-        #    print(response)
\ No newline at end of file
+        #    print(response)
+
+    def test_admin_changelist(self):
+        class SimpleModelAdmin(builder.create_modeladmin()):
+            list_display = ('name',)
+            custom_list_display = ('int_field', 'boolean_field', 'unknown_field')
+            custom_list_filter = ('boolean_field',)
+            custom_ordering = ('-int_field',)
+
+        modeladmin = SimpleModelAdmin(SimpleModelWithManager, AdminSite())
+        request = self.factory.get('/admin/tests/simplemodelwithmanager/')
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+
+        objs = [self.obj]
+        for i in range(10):
+            obj = SimpleModelWithManager.objects.create(name='simple %d' % i)
+            obj.set_custom_values({ 'int_field': i, 'boolean_field': i % 2 == 0 })
+            objs.append(obj)
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(3):
+            # filter choices, count, results
+            response = modeladmin.changelist_view(request)
+            result_list = list(response.context_data['cl'].result_list)
+        self.assertEqual([9, 8, 7, 6, 5, 4, 3, 2, 1, 0, None], [o.int_field for o in result_list])
+
+        columns = modeladmin.get_list_display(request)
+        self.assertEqual(['name', 'int_field', 'boolean_field'],
+                         [getattr(c, '__name__', c) for c in columns])
+        self.assertEqual("Integer field", columns[1].short_description)
+        self.assertEqual('int_field', columns[1].admin_order_field)
+        self.assertTrue(columns[2].boolean)
+
+        request = self.factory.get('/admin/tests/simplemodelwithmanager/', { 'custom_boolean_field': 'False' })
+        request.user = User.objects.get(username='admin')
+        response = modeladmin.changelist_view(request)
+        self.assertEqual([9, 7, 5, 3, 1], [o.int_field for o in response.context_data['cl'].result_list])
+
+    def test_export_custom_values(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        lastobj = SimpleModelWithManager.objects.create(name='last simple')
+        self.obj.set_custom_values({ 'text_field': "comma, \"quoted\"", 'int_field': 5 })
+        newobj.set_custom_values({ 'int_field': 1, 'date_field': date(2015, 6, 1) })
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(4):
+            # two chunks, each one query for objects and one for values
+            lines = list(builder.export_custom_values(SimpleModelWithManager.objects.order_by('-name'),
+                                                      field_names=('text_field', 'int_field', 'date_field'),
+                                                      model_fields=('pk', 'name'),
+                                                      chunk_size=2))
+        self.assertEqual(['pk,name,text_field,int_field,date_field\r\n',
+                          '%d,old test,"comma, ""quoted""",5,\r\n' % self.obj.pk,
+                          '%d,new simple,,1,2015-06-01\r\n' % newobj.pk,
+                          '%d,last simple,,,\r\n' % lastobj.pk], lines)
+
+        lines = list(builder.export_custom_values(SimpleModelWithManager.objects.filter(pk=newobj.pk),
+                                                  format='jsonl',
+                                                  field_names=('int_field', 'date_field')))
+        self.assertEqual(['{"date_field": "2015-06-01", "int_field": 1, "pk": %d}\n' % newobj.pk], lines)
+
+        with self.assertRaises(ValueError):
+            builder.export_custom_values(SimpleModelWithManager.objects.all(), format='xml')
+
+        output = six.StringIO()
+        call_command('custard_export', 'tests.SimpleModelWithManager', format='jsonl',
+                     fields='int_field', stdout=output)
+        self.assertEqual(['{"int_field": 5, "pk": %d}' % self.obj.pk,
+                          '{"int_field": 1, "pk": %d}' % newobj.pk,
+                          '{"int_field": null, "pk": %d}' % lastobj.pk],
+                         output.getvalue().splitlines())
+
+    def test_import_custom_values(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        limited = CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                                   name='limited_field',
+                                                   label="Limited field",
+                                                   data_type=CUSTOM_TYPE_INTEGER,
+                                                   min_value=0,
+                                                   max_value=10)
+        self.obj.set_custom_values({ 'int_field': 1 })
+        # single values are validated on the field rules too, before any write
+        with self.assertRaises(ValidationError) as cm:
+            self.obj.set_custom_value(limited, 11)
+        self.assertEqual(['limited_field'], list(cm.exception.message_dict.keys()))
+        self.assertFalse(CustomValuesModel.objects.filter(custom_field=limited).exists())
+        lines = ['pk,int_field,text_field,limited_field\r\n',
+                 '%d,5,hello,\r\n' % self.obj.pk,
+                 '%d,abc,x,\r\n' % newobj.pk,
+                 '%d,7,x,11\r\n' % newobj.pk,
+                 '9999,1,,\r\n',
+                 '%d,3,,10\r\n' % newobj.pk]
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(7):
+            # objects, values, savepoint, insert, select pks, update, release
+            result = builder.import_custom_values(SimpleModelWithManager, csv_rows(lines))
+        self.assertEqual(3, result['created'])
+        self.assertEqual(1, result['updated'])
+        self.assertEqual([2, 3, 4], [number for number, errors in result['errors']])
+        self.assertEqual(['int_field'], list(result['errors'][0][1].keys()))
+        self.assertEqual(['limited_field'], list(result['errors'][1][1].keys()))
+        self.assertEqual(['pk'], list(result['errors'][2][1].keys()))
+        self.assertEqual(5, self.obj.get_custom_value(self.cf3).value)
+        self.assertEqual("hello", self.obj.get_custom_value(self.cf).value)
+        self.assertEqual(3, newobj.get_custom_value(self.cf3).value)
+        with self.assertRaises(ObjectDoesNotExist):
+            newobj.get_custom_value(self.cf)
+
+        rows = [{ 'pk': self.obj.pk, 'int_field': 6, 'float_field': 1.5 }, { 'pk': newobj.pk, 'unknown': 1 }]
+        result = builder.import_custom_values(SimpleModelWithManager, rows, on_conflict='error')
+        self.assertEqual([1, 2], [number for number, errors in result['errors']])
+        self.assertEqual({ 'int_field' }, set(result['errors'][0][1].keys()))
+        result = builder.import_custom_values(SimpleModelWithManager, rows[:1], on_conflict='skip')
+        self.assertEqual((1, 0, 1), (result['created'], result['updated'], result['skipped']))
+        self.assertEqual(5, self.obj.get_custom_value(self.cf3).value)
+        self.assertEqual(1.5, self.obj.get_custom_value(self.cf5).value)
+
+        # model columns of an export are ignored
+        rows = [{ 'pk': self.obj.pk, 'id': self.obj.pk, 'name': 'renamed', 'int_field': 4 }]
+        result = builder.import_custom_values(SimpleModelWithManager, rows)
+        self.assertEqual([], result['errors'])
+        self.assertEqual(4, self.obj.get_custom_value(self.cf3).value)
+        self.assertEqual('old test', SimpleModelWithManager.objects.get(pk=self.obj.pk).name)
+
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.jsonl', delete=False) as input:
+            input.write(('{"pk": %d, "int_field": 8}\n{"pk": %d, "int_field": "x"}\n' %
+                         (self.obj.pk, newobj.pk)).encode('utf-8'))
+        try:
+            stdout, stderr = six.StringIO(), six.StringIO()
+            call_command('custard_import', 'tests.SimpleModelWithManager', input.name,
+                         format='jsonl', stdout=stdout, stderr=stderr)
+        finally:
+            os.remove(input.name)
+        self.assertEqual("0 created, 1 updated, 0 skipped, 1 rows with errors\n", stdout.getvalue())
+        self.assertTrue(stderr.getvalue().startswith("Row 2, int_field: "))
+        self.assertEqual(8, self.obj.get_custom_value(self.cf3).value)
+
+    def test_materialized_table(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        self.obj.set_custom_values({ 'int_field': 5, 'date_field': date(2015, 1, 1) })
+
+        table = builder.materialize(SimpleModelWithManager)
+        try:
+            table.rebuild()
+            rows = table.get_table_model().objects.all()
+            self.assertEqual([(self.obj.pk, 5, date(2015, 1, 1))],
+                             list(rows.values_list('object_id', 'int_field', 'date_field')))
+
+            # values written are refreshed incrementally
+            builder.get_fields_for_content_type(self.simple_with_manager_ct)
+            with self.assertNumQueries(11):
+                # select, savepoint, insert, select pks,
+                # refresh (savepoint, lock, select, delete, insert, release), release
+                newobj.set_custom_values({ 'int_field': 1, 'text_field': "abc" })
+            self.obj.get_custom_value(self.cf6).delete()
+            self.assertEqual([(self.obj.pk, 5, None, None), (newobj.pk, 1, None, "abc")],
+                             list(rows.order_by('object_id').values_list('object_id', 'int_field',
+                                                                         'date_field', 'text_field')))
+
+            # filter_custom runs on the wide table
+            self.assertEqual([newobj], list(SimpleModelWithManager.objects.filter_custom(int_field__lt=3)))
+            self.assertEqual([self.obj], list(SimpleModelWithManager.objects.filter_custom(text_field__isnull=True)))
+            self.assertIn(table.db_table, str(SimpleModelWithManager.objects.filter_custom(int_field=1).query))
+            with self.assertRaises(FieldError):
+                SimpleModelWithManager.objects.filter_custom(unknown_field=1)
+
+            # schema changes make the table stale until it's rebuilt
+            new_field = CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                                         name='new_field',
+                                                         label="New field",
+                                                         data_type=CUSTOM_TYPE_INTEGER)
+            self.assertTrue(table.is_stale())
+            newobj.set_custom_values({ 'new_field': 7 })
+            queryset = SimpleModelWithManager.objects.filter_custom(new_field=7)
+            self.assertNotIn(table.db_table, str(queryset.query))
+            self.assertEqual([newobj], list(queryset))
+
+            output = six.StringIO()
+            call_command('custard_materialize', 'tests.SimpleModelWithManager', stdout=output)
+            self.assertIn('tests.simplemodelwithmanager: %s rebuilt' % table.db_table, output.getvalue())
+            self.assertFalse(table.is_stale())
+            self.assertEqual([None, 7], list(table.get_table_model().objects.order_by('object_id')
+                                                                      .values_list('new_field', flat=True)))
+            output = six.StringIO()
+            call_command('custard_materialize', '--builder', 'custard.tests.models.builder', stdout=output)
+            self.assertIn('tests.simplemodelwithmanager: up to date', output.getvalue())
+
+            # data type changes make it stale too
+            new_field.data_type = CUSTOM_TYPE_TEXT
+            new_field.save()
+            self.assertTrue(table.is_stale())
+            table.rebuild()
+
+            # names clashing with the table model can't be materialized
+            new_field.name = 'new__field'
+            new_field.save()
+            self.assertTrue(table.is_stale())
+            with self.assertRaises(ImproperlyConfigured):
+                table.rebuild()
+        finally:
+            builder.materialized_tables.remove(table)
+            table.drop()
+
+    def test_json_storage_engine(self):
+        content_type = ContentType.objects.get_for_model(SimpleModelWithJSON)
+        cf_text = CustomFieldsModel.objects.create(content_type=content_type,
+                                                   name='text_field',
+                                                   label="Text field",
+                                                   data_type=CUSTOM_TYPE_TEXT)
+        cf_int = CustomFieldsModel.objects.create(content_type=content_type,
+                                                  name='int_field',
+                                                  label="Integer field",
+                                                  data_type=CUSTOM_TYPE_INTEGER)
+        cf_date = CustomFieldsModel.objects.create(content_type=content_type,
+                                                   name='date_field',
+                                                   label="Date field",
+                                                   data_type=CUSTOM_TYPE_DATE)
+        obj = SimpleModelWithJSON.objects.create(name='json')
+        other = SimpleModelWithJSON.objects.create(name='other')
+
+        builder_json.get_fields_for_content_type(content_type)
+        # savepoint, locked read of the stored document, update, release
+        with self.assertNumQueries(4):
+            obj.set_custom_values({ 'text_field': "Caff\u00e8 latte", 'int_field': "42" })
+        # a stale instance doesn't overwrite values written meanwhile
+        stale = SimpleModelWithJSON.objects.get(pk=obj.pk)
+        stale.custom_values = ''
+        stale.set_custom_value(cf_date, date(2015, 1, 1))
+        self.assertEqual(42, stale.get_custom_value(cf_int).value)
+        other.set_custom_value(cf_text, "tea")
+        with self.assertRaises(ValidationError):
+            obj.set_custom_values({ 'int_field': "not an integer" })
+        self.assertEqual(0, CustomValuesModel.objects.count())
+
+        obj = SimpleModelWithJSON.objects.get(pk=obj.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual("Caff\u00e8 latte", obj.get_custom_value(cf_text).value)
+            self.assertEqual(42, obj.get_custom_value(cf_int).value)
+            self.assertEqual(date(2015, 1, 1), obj.get_custom_value(cf_date).value)
+        with self.assertRaises(ObjectDoesNotExist):
+            other.get_custom_value(cf_int)
+
+        self.assertEqual([obj], list(SimpleModelWithJSON.objects.search("FF\u00e8 L")))
+        self.assertEqual([other], list(SimpleModelWithJSON.objects.search("tea")))
+        self.assertEqual([], list(SimpleModelWithJSON.objects.search("42")))
+
+        special = SimpleModelWithJSON.objects.create(name='special')
+        special.set_custom_values({ 'text_field': 'say "hi" there (1+1) [a.b] C:\\dir' })
+        for search in ("there", '"hi" t', "(1+1)", "[a.b]", "C:\\dir"):
+            self.assertEqual([special], list(SimpleModelWithJSON.objects.search(search)))
+        for search in ("[axb]", "1+1)$", '"hi""', "C:\\\\dir"):
+            self.assertEqual([], list(SimpleModelWithJSON.objects.search(search)))
+
+        class JSONForm(builder_json.create_modelform()):
+            class Meta:
+                model = SimpleModelWithJSON
+                fields = ('name',)
+
+        with self.assertNumQueries(0):
+            form = JSONForm(instance=obj)
+        self.assertEqual(42, form.initial['int_field'])
+        form = JSONForm(data={ 'name': 'json', 'text_field': "espresso", 'int_field': "7",
+                               'date_field': "" }, instance=obj)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        obj = SimpleModelWithJSON.objects.get(pk=obj.pk)
+        self.assertEqual("espresso", obj.get_custom_value(cf_text).value)
+        self.assertEqual(7, obj.get_custom_value(cf_int).value)
+        self.assertEqual(None, obj.get_custom_value(cf_date).value)
+
+        # features querying the values model are not available
+        queryset = SimpleModelWithJSON.objects.all()
+        for call in (lambda: queryset.filter_custom(int_field=7),
+                     lambda: queryset.with_custom_fields('int_field'),
+                     lambda: queryset.order_by_custom('int_field'),
+                     lambda: queryset.keyset_custom('int_field'),
+                     lambda: queryset.aggregate_custom(Sum('int_field')),
+                     lambda: queryset.prefetch_custom_values(),
+                     lambda: builder_json.prefetch_custom_values([obj]),
+                     lambda: builder_json.export_custom_values(queryset),
+                     lambda: builder_json.import_custom_values(SimpleModelWithJSON, []),
+                     lambda: builder_json.materialize(SimpleModelWithJSON)):
+            self.assertRaises(ImproperlyConfigured, call)
+
+    def test_values_model_indexes(self):
+        self.assertEqual([('content_type', 'object_id'),
+                          ('custom_field', 'value_integer'),
+                          ('custom_field', 'value_float'),
+                          ('custom_field', 'value_date'),
+                          ('custom_field', 'value_datetime')],
+                         [tuple(index) for index in CustomValuesUniqueModel._meta.index_together])
+        self.assertEqual([('custom_field', 'content_type', 'object_id')],
+                         [tuple(unique) for unique in CustomValuesUniqueModel._meta.unique_together])
+
+        values_model = builder.create_values(indexes=(), typed_indexes=(CUSTOM_TYPE_DATE,))
+        self.assertEqual([('custom_field', 'value_date')], values_model.Meta.index_together)
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, CustomValuesUniqueModel._meta.db_table)
+        indexed = [tuple(c['columns']) for c in constraints.values() if c['index']]
+        self.assertIn(('content_type_id', 'object_id'), indexed)
+        self.assertIn(('custom_field_id', 'value_integer'), indexed)
+
+    def test_custom_values_accessor(self):
+        self.obj.set_custom_values({ 'text_field': "abc", 'int_field': 5 })
+        obj = SimpleModelWithManager.objects.get(pk=self.obj.pk)
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(1):
+            self.assertEqual("abc", obj.custom.text_field)
+            self.assertEqual(5, obj.custom['int_field'])
+            self.assertEqual(None, obj.custom.date_field)
+            self.assertIn('float_field', obj.custom)
+            fields = builder.get_fields_for_content_type(self.simple_with_manager_ct)
+            self.assertEqual(set(f.name for f in fields), set(obj.custom))
+        with self.assertRaises(AttributeError):
+            obj.custom.unknown_field
+        with self.assertRaises(KeyError):
+            obj.custom['unknown_field'] = 1
+
+        obj.custom.int_field = "42"
+        obj.custom['date_field'] = date(2015, 1, 1)
+        self.assertTrue(obj.custom.is_dirty())
+        self.assertEqual({ 'int_field': "42", 'date_field': date(2015, 1, 1) }, obj.custom.dirty)
+        with self.assertNumQueries(6):
+            # select, savepoint, insert, select pks, update, release
+            obj.custom.save()
+        self.assertFalse(obj.custom.is_dirty())
+        self.assertEqual(42, obj.custom.int_field)
+        self.assertEqual(42, self.obj.get_custom_value(self.cf3).value)
+        self.assertEqual(date(2015, 1, 1), self.obj.get_custom_value(self.cf6).value)
+
+        obj.custom.int_field = "not an integer"
+        with self.assertRaises(ValidationError):
+            obj.custom.save()
+        self.assertTrue(obj.custom.is_dirty())
+        obj.custom.refresh()
+        self.assertEqual(42, obj.custom.int_field)
+
+        obj.set_custom_value(self.cf, "def")
+        self.assertEqual("def", obj.custom.text_field)
+
+        objs = list(SimpleModelWithManager.objects.prefetch_custom_values())
+        with self.assertNumQueries(0):
+            self.assertEqual(["def"], [o.custom.text_field for o in objs])
+
+    def test_values_cache(self):
+        self.obj.set_custom_values({ 'text_field': "abc", 'int_field': 5 })
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        builder.values_cache = 'default'
+        caches['default'].clear()
+        try:
+            with self.assertNumQueries(1):
+                self.assertEqual("abc", self.obj.get_custom_value(self.cf).value)
+            obj = SimpleModelWithManager.objects.get(pk=self.obj.pk)
+            with self.assertNumQueries(0):
+                self.assertEqual(5, obj.get_custom_value(self.cf3).value)
+                self.assertEqual(5, obj.custom.int_field)
+                form = SimpleModelWithManagerForm(instance=obj)
+            self.assertEqual("abc", form.initial['text_field'])
+            with self.assertRaises(ObjectDoesNotExist):
+                obj.get_custom_value(self.cf6)
+
+            # writes invalidate the cache
+            obj.set_custom_value(self.cf3, 6)
+            self.assertEqual(6, self.obj.get_custom_value(self.cf3).value)
+            form = SimpleModelWithManagerForm(data={ 'name': 'old test',
+                                                     'text_field': "def",
+                                                     'another_text_field': "ghi",
+                                                     'int_field': "7" }, instance=obj)
+            self.assertTrue(form.is_valid(), form.errors)
+            form.save()
+            self.assertEqual(7, self.obj.get_custom_value(self.cf3).value)
+            self.assertEqual("ghi", self.obj.get_custom_value(self.cf2).value)
+            self.assertEqual(1, CustomValuesModel.objects.filter(custom_field=self.cf3,
+                                                                 object_id=self.obj.pk).count())
+            CustomValuesModel.objects.filter(custom_field=self.cf3).delete()
+            with self.assertRaises(ObjectDoesNotExist):
+                self.obj.get_custom_value(self.cf3)
+        finally:
+            builder.values_cache = None
+
+    def test_memoize(self):
+        self.obj.set_custom_values({ 'text_field': "abc", 'int_field': 5 })
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        obj = SimpleModelWithManager.objects.get(pk=self.obj.pk)
+        with memoize():
+            with self.assertNumQueries(1):
+                self.assertEqual("abc", self.obj.get_custom_value(self.cf).value)
+            with self.assertNumQueries(0):
+                self.assertEqual(5, obj.get_custom_value(self.cf3).value)
+                self.assertEqual(5, obj.custom.int_field)
+                self.assertEqual("abc", SimpleModelWithManagerForm(instance=obj).initial['text_field'])
+            with memoize():
+                with self.assertNumQueries(0):
+                    self.assertEqual(5, self.obj.get_custom_value(self.cf3).value)
+            obj.set_custom_value(self.cf3, 6)
+            self.assertEqual(6, self.obj.get_custom_value(self.cf3).value)
+        self.assertEqual(None, get_memo())
+        with self.assertNumQueries(1):
+            self.assertEqual(6, self.obj.get_custom_value(self.cf3).value)
+
+        middleware = MemoizeMiddleware()
+        request = self.factory.get('/')
+        middleware.process_request(request)
+        self.assertEqual({}, get_memo())
+        self.obj.get_custom_value(self.cf3)
+        with self.assertNumQueries(0):
+            self.obj.get_custom_value(self.cf)
+        response = middleware.process_response(request, 'response')
+        self.assertEqual('response', response)
+        self.assertEqual(None, get_memo())
+
+        # a memo left by a request without process_response isn't reused
+        middleware.process_request(request)
+        self.obj.get_custom_value(self.cf3)
+        middleware.process_request(request)
+        self.assertEqual({}, get_memo())
+        # request_finished also closes the database connection of the test
+        receivers = request_finished._live_receivers(None)
+        self.assertIn(_clear_memo, receivers)
+        _clear_memo(sender=None)
+        self.assertEqual(None, get_memo())
+
+    def test_aggregate_custom(self):
+        newobj = SimpleModelWithManager.objects.create(name='new simple')
+        lastobj = SimpleModelWithManager.objects.create(name='last simple')
+        self.obj.set_custom_values({ 'int_field': 5, 'float_field': 1.5, 'date_field': date(2015, 1, 1) })
+        newobj.set_custom_values({ 'int_field': 1, 'float_field': 2.5, 'date_field': date(2015, 6, 1) })
+        lastobj.set_custom_values({ 'text_field': "abc" })
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(1):
+            result = SimpleModelWithManager.objects.aggregate_custom(Sum('int_field'),
+                                                                     Count('int_field'),
+                                                                     average=Avg('float_field'),
+                                                                     first=Min('date_field'),
+                                                                     last=Max('date_field'))
+        self.assertEqual({ 'int_field__sum': 6,
+                           'int_field__count': 2,
+                           'average': 2.0,
+                           'first': date(2015, 1, 1),
+                           'last': date(2015, 6, 1) }, result)
+
+        result = SimpleModelWithManager.objects.exclude(pk=newobj.pk).aggregate_custom(Sum('int_field'))
+        self.assertEqual({ 'int_field__sum': 5 }, result)
+
+        rows = SimpleModelWithManager.objects.values('name') \
+                                             .annotate_custom(total=Sum('int_field')) \
+                                             .order_by('name')
+        self.assertEqual([('last simple', None), ('new simple', 1), ('old test', 5)],
+                         [(row['name'], row['total']) for row in rows])
+
+        rows = SimpleModelWithManager.objects.annotate_custom(double=F('int_field') * 2) \
+                                             .order_by('name').values_list('name', 'double')
+        self.assertEqual([('last simple', None), ('new simple', 2), ('old test', 10)], list(rows))
+
+    def test_order_by_custom(self):
+        objs = [self.obj]
+        for i in range(6):
+            objs.append(SimpleModelWithManager.objects.create(name='simple %d' % i))
+        SimpleModelWithManager.objects.bulk_set_custom_values(objs[:5], [{ 'int_field': 3 },
+                                                                         { 'int_field': 1 },
+                                                                         { 'int_field': 3 },
+                                                                         { 'int_field': 2 },
+                                                                         { 'int_field': -1 }])
+
+        builder.get_fields_for_content_type(self.simple_with_manager_ct)
+        with self.assertNumQueries(1):
+            ordered = list(SimpleModelWithManager.objects.order_by_custom('int_field', '-name'))
+        self.assertEqual([objs[4], objs[1], objs[3], objs[2], objs[0], objs[6], objs[5]], ordered)
+        self.assertEqual([-1, 1, 2, 3, 3, None, None], [o.int_field for o in ordered])
+        ordered = list(SimpleModelWithManager.objects.with_custom_fields('int_field')
+                                                     .order_by_custom('-int_field', 'name'))
+        self.assertEqual([objs[0], objs[2], objs[3], objs[1], objs[4], objs[5], objs[6]], ordered)
+
+        for field_name, expected in (('int_field', [4, 1, 3, 0, 2, 5, 6]),
+                                     ('-int_field', [2, 0, 3, 1, 4, 6, 5])):
+            pages, key = [], None
+            while True:
+                page, key = SimpleModelWithManager.objects.keyset_custom(field_name, after=key, size=2)
+                pages.append(page)
+                if key is None:
+                    break
+            self.assertEqual([2, 2, 2, 1], [len(page) for page in pages])
+            self.assertEqual([objs[i] for i in expected], [o for page in pages for o in page])
+
+        page, key = SimpleModelWithManager.objects.filter(name__startswith='simple') \
+                                                  .keyset_custom('int_field', size=3)
+        self.assertEqual([objs[4], objs[1], objs[3]], page)
+        self.assertEqual((2, objs[3].pk), key)
+        self.assertEqual([-1, 1, 2], [o.int_field for o in page])
+
+        # orphan values (object deleted bypassing the relation) don't end the valued pages
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE id = %%s' % SimpleModelWithManager._meta.db_table,
+                           [objs[1].pk])
+        pages, key = [], None
+        while True:
+            page, key = SimpleModelWithManager.objects.keyset_custom('int_field', after=key, size=2)
+            pages.extend(page)
+            if key is None:
+                break
+        self.assertEqual([objs[i] for i in (4, 3, 0, 2, 5, 6)], pages)
+
+    def test_delete_orphan_values(self):
+        obj = SimpleModelWithManager.objects.create(name='deleted simple')
+        obj.set_custom_values({ 'text_field': 'gone', 'int_field': 1 })
+        self.obj.set_custom_values({ 'int_field': 2 })
+        SimpleModelWithManager.objects.filter(pk=obj.pk).delete()
+        self.assertFalse(CustomValuesModel.objects.filter(content_type=self.simple_with_manager_ct,
+                                                          object_id=obj.pk).exists())
+        self.assertEqual(2, self.obj.get_custom_value(self.cf3).value)
+
+        cf = CustomFieldsModel.objects.create(content_type=self.simple_without_manager_ct,
+                                              name='text_field',
+                                              label="Text field",
+                                              data_type=CUSTOM_TYPE_TEXT)
+        objs = [SimpleModelWithoutManager.objects.create(name='simple %d' % i) for i in range(3)]
+        for obj in objs:
+            value = CustomValuesModel(custom_field=cf,
+                                      content_type=self.simple_without_manager_ct,
+                                      object_id=obj.pk)
+            value.value = obj.name
+            value.save()
+        SimpleModelWithoutManager.objects.filter(pk__in=[objs[0].pk, objs[2].pk]).delete()
+        values = CustomValuesModel.objects.filter(content_type=self.simple_without_manager_ct)
+
+        self.assertEqual(2, builder.delete_orphan_values(self.simple_without_manager_ct, dry_run=True))
+        self.assertEqual(3, values.count())
+        self.assertEqual(0, builder.delete_orphan_values(self.simple_with_manager_ct))
+
+        # objects hidden by the default manager still exist
+        visibility_ct = ContentType.objects.get_for_model(SimpleModelWithVisibility)
+        hidden = SimpleModelWithVisibility.objects.create(name='hidden', visible=False)
+        # content types without model are skipped unless asked
+        stale_ct = ContentType.objects.create(app_label='tests', model='removedmodel')
+        for content_type, object_id in ((visibility_ct, hidden.pk), (stale_ct, 1)):
+            field = CustomFieldsModel.objects.create(content_type=content_type,
+                                                     name='text_field',
+                                                     label="Text field",
+                                                     data_type=CUSTOM_TYPE_TEXT)
+            value = CustomValuesModel(custom_field=field, content_type=content_type, object_id=object_id)
+            value.value = 'kept'
+            value.save()
+        self.assertEqual(0, builder.delete_orphan_values(visibility_ct))
+        self.assertEqual(0, builder.delete_orphan_values(stale_ct))
+
+        deleted = []
+        builder.values_deleted = deleted.append
+        try:
+            output = six.StringIO()
+            call_command('custard_gc', '--builder', 'custard.tests.models.builder',
+                         '--chunk-size', '10', stdout=output)
+        finally:
+            del builder.values_deleted
+        # one call per chunk, no signal per value
+        self.assertEqual([2], [len(chunk) for chunk in deleted])
+        self.assertIn('tests.simplemodelwithoutmanager: 2 orphan values deleted', output.getvalue())
+        self.assertIn('tests.simplemodelwithmanager: 0 orphan values deleted', output.getvalue())
+        self.assertIn('tests.simplemodelwithvisibility: 0 orphan values deleted', output.getvalue())
+        self.assertIn('tests.removedmodel: skipped', output.getvalue())
+        self.assertEqual([objs[1].pk], list(values.values_list('object_id', flat=True)))
+        self.assertTrue(CustomValuesModel.objects.filter(content_type=visibility_ct).exists())
+
+        output = six.StringIO()
+        call_command('custard_gc', '--builder', 'custard.tests.models.builder',
+                     '--include-stale', '--chunk-size', '1', stdout=output)
+        self.assertIn('tests.removedmodel: 1 orphan values deleted', output.getvalue())
+        self.assertFalse(CustomValuesModel.objects.filter(content_type=stale_ct).exists())
+
+
+#==============================================================================
+class CustomModelsTransactionTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.simple_with_manager_ct = ContentType.objects.get_for_model(SimpleModelWithManager)
+        self.cf = CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                                   name='int_field', label="Integer field",
+                                                   data_type=CUSTOM_TYPE_INTEGER)
+        self.obj = SimpleModelWithManager.objects.create(name='committed')
+        self.obj.set_custom_values({ 'int_field': 1 })
+
+    def test_values_cache_after_commit(self):
+        builder.values_cache = 'default'
+        caches['default'].clear()
+        key = builder.get_values_cache_key(self.simple_with_manager_ct.pk, self.obj.pk)
+        try:
+            with transaction.atomic():
+                self.obj.set_custom_values({ 'int_field': 2 })
+                # another process caches the values committed before
+                caches['default'].set(key, { self.cf.pk: (None, 1) })
+            self.assertIsNone(caches['default'].get(key))
+            obj = SimpleModelWithManager.objects.get(pk=self.obj.pk)
+            self.assertEqual(2, obj.get_custom_value(self.cf).value)
+        finally:
+            builder.values_cache = None
+
+    def test_fields_cache_after_rollback(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                CustomFieldsModel.objects.create(content_type=self.simple_with_manager_ct,
+                                                 name='rolled_back', label="Rolled back",
+                                                 data_type=CUSTOM_TYPE_TEXT)
+                # read (and cached) before the rollback
+                builder.get_field_for_name(self.simple_with_manager_ct, 'rolled_back')
+                raise ValueError
+        self.assertEqual(['int_field'],
+                         [f.name for f in builder.get_fields_for_content_type(self.simple_with_manager_ct)])
+
+    def test_delete_orphan_values_after_commit(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE id = %%s' % SimpleModelWithManager._meta.db_table,
+                           [self.obj.pk])
+        committed = []
+
+        def values_deleted(values):
+            committed.append((len(values), connection.in_atomic_block,
+                              CustomValuesModel.objects.filter(object_id=self.obj.pk).exists()))
+        builder.values_deleted = values_deleted
+        try:
+            self.assertEqual(1, builder.delete_orphan_values(self.simple_with_manager_ct))
+        finally:
+            del builder.values_deleted
+        self.assertEqual([(1, False, False)], committed)
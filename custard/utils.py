@@ -1,5 +1,12 @@
 from __future__ import unicode_literals
+import csv
+import json
 from importlib import import_module
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Case, When, Value
+from django.utils import six
+from django.utils.encoding import force_text
 
 #==============================================================================
 def import_class(name):
@@ -8,3 +15,165 @@ def import_class(name):
     for comp in components[1:]:
         mod = getattr(mod, comp)
     return mod
+
+
+#==============================================================================
+def bulk_update(objs, fields, batch_size=250):
+    """
+    Update the given fields of many saved instances of the same model using a
+    single UPDATE query per field and batch, much like ``QuerySet.bulk_update``
+    which is used instead when available.
+
+    :param objs: model instances to update
+    :param fields: names of the fields to update
+    :param batch_size: how many instances are updated in each query
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    manager = objs[0].__class__._default_manager
+    if hasattr(manager, 'bulk_update'):
+        manager.bulk_update(objs, fields, batch_size=batch_size)
+        return
+    opts = objs[0]._meta
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        for name in fields:
+            field = opts.get_field(name)
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field))
+                     for obj in batch]
+            manager.filter(pk__in=[obj.pk for obj in batch]) \
+                   .update(**{ field.attname: Case(*whens, output_field=field) })
+
+
+#==============================================================================
+def after_transaction(func, using=None):
+    """
+    Call func when the outermost atomic block of a connection exits, after
+    the transaction is committed or rolled back, so caches can be cleared
+    once other connections see the changes. Does nothing outside atomic
+    blocks, callers are expected to call func right away too.
+
+    :param func: a callable without arguments
+    :param using: the database alias
+    """
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if not connection.in_atomic_block:
+        return
+    hooks = getattr(connection, '_custard_transaction_hooks', None)
+    if hooks is None:
+        hooks = connection._custard_transaction_hooks = []
+        commit, rollback = connection.commit, connection.rollback
+
+        def run_hooks():
+            while hooks:
+                hooks.pop(0)()
+
+        def wrapped_commit():
+            try:
+                commit()
+            finally:
+                run_hooks()
+
+        def wrapped_rollback():
+            try:
+                rollback()
+            finally:
+                run_hooks()
+
+        connection.commit = wrapped_commit
+        connection.rollback = wrapped_rollback
+    hooks.append(func)
+
+
+#==============================================================================
+class _Echo(object):
+    """ File-like object returning what is written, to get csv lines one by one """
+    def write(self, value):
+        return value
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    value = force_text(value)
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def csv_lines(columns, rows):
+    """
+    Generate the lines of a CSV document, a header with the column names
+    followed by a line for each row
+
+    :param columns: the column names
+    :param rows: an iterable of dicts of column names to values
+    """
+    writer = csv.writer(_Echo())
+    for values in _iter_values(columns, rows):
+        line = writer.writerow([_csv_cell(value) for value in values])
+        yield line.decode('utf-8') if six.PY2 else line
+
+
+def jsonl_lines(columns, rows):
+    """
+    Generate the lines of a JSON Lines document, an object for each row
+
+    :param columns: the column names
+    :param rows: an iterable of dicts of column names to values
+    """
+    for row in rows:
+        yield json.dumps(dict((column, row[column]) for column in columns),
+                         cls=DjangoJSONEncoder, sort_keys=True) + '\n'
+
+
+def _iter_values(columns, rows):
+    yield columns
+    for row in rows:
+        yield [row[column] for column in columns]
+
+
+EXPORT_FORMATS = {
+    'csv': csv_lines,
+    'jsonl': jsonl_lines,
+}
+
+
+#==============================================================================
+def csv_rows(lines):
+    """
+    Read the rows of a CSV document with a header line
+
+    :param lines: an iterable of text lines, like a file opened with ``newline=''``
+    :return: a generator of dicts of column names to strings
+    """
+    if six.PY2:
+        lines = (line.encode('utf-8') for line in lines)
+    reader = csv.reader(lines)
+    columns = None
+    for values in reader:
+        if six.PY2:
+            values = [value.decode('utf-8') for value in values]
+        if columns is None:
+            columns = values
+        elif values:
+            yield dict(zip(columns, values))
+
+
+def jsonl_rows(lines):
+    """
+    Read the rows of a JSON Lines document, blank lines are ignored
+
+    :param lines: an iterable of text lines
+    :return: a generator of dicts
+    """
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+IMPORT_FORMATS = {
+    'csv': csv_rows,
+    'jsonl': jsonl_rows,
+}
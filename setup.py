@@ -15,7 +15,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        "Django >= 1.7",
+        "Django >= 1.8",
     ],
     keywords=[
         'django',